@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the data layer and the API.
+"""
+
+import csv
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from multiprocessing import Process, Queue
+
+from lxml import etree
+
+from presence_analyzer import utils
+from presence_analyzer.main import app
+
+
+def load_dict_layout(path):
+    """
+    Loads presence CSV into the nested dict layout used before
+    PresenceStore, for comparison.
+    """
+    data = {}
+    with open(path, 'r') as csvfile:
+        for row in csv.reader(csvfile, delimiter=','):
+            if len(row) != 4:
+                continue
+            try:
+                user_id = int(row[0])
+                date = datetime.strptime(row[1], '%Y-%m-%d').date()
+                start = datetime.strptime(row[2], '%H:%M:%S').time()
+                end = datetime.strptime(row[3], '%H:%M:%S').time()
+            except (ValueError, TypeError):
+                continue
+            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+    return data
+
+
+def deep_sizeof(obj):
+    """
+    Estimates memory in bytes held by object and everything it references.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.iterkeys())
+            stack.extend(item.itervalues())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif hasattr(item, '__slots__'):
+            stack.extend(
+                getattr(item, name) for name in item.__slots__
+                if hasattr(item, name)
+            )
+    return size
+
+
+def timed(function, *args):
+    """
+    Calls function with given arguments and returns (result, seconds).
+    """
+    started = time.time()
+    result = function(*args)
+    return result, time.time() - started
+
+
+def compare_layouts(path):
+    """
+    Measures load time and memory of the dict layout and PresenceStore.
+    """
+    results = {}
+    for name, loader in (('dict', load_dict_layout),
+                         ('columnar', utils.load_presence_csv)):
+        data, seconds = timed(loader, path)
+        results[name] = {'seconds': seconds, 'bytes': deep_sizeof(data)}
+        del data
+    return results
+
+
+def scale_csv(path, scale):
+    """
+    Writes temporary CSV file with content of given one repeated 'scale'
+    times, each copy with distinct user ids. Returns its path.
+    """
+    with open(path, 'r') as csvfile:
+        rows = [line.rstrip('\r\n').split(',', 1) for line in csvfile]
+    handle, scaled_path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(handle, 'w') as scaled:
+        for copy in xrange(scale):
+            offset = copy * 100000
+            for row in rows:
+                if len(row) == 2 and row[0].isdigit():
+                    scaled.write('%d,%s\n' % (int(row[0]) + offset, row[1]))
+    return scaled_path
+
+
+def count_rows(path):
+    """
+    Returns amount of lines in given file.
+    """
+    with open(path, 'r') as csvfile:
+        return sum(1 for _ in csvfile)
+
+
+def parse_throughput(path, scale=100):
+    """
+    Measures parsing speed in rows per second of the strptime based parser
+    and of the slicing parser, on given CSV file scaled up 'scale' times.
+    """
+    scaled_path = scale_csv(path, scale)
+    try:
+        rows = count_rows(scaled_path)
+        results = {}
+        for name, loader in (('strptime', load_dict_layout),
+                             ('slicing', utils.load_presence_csv)):
+            seconds = timed(loader, scaled_path)[1]
+            results[name] = {'rows': rows, 'rows_per_second': rows / seconds}
+        return results
+    finally:
+        os.remove(scaled_path)
+
+
+def load_users_tree(path):
+    """
+    Loads users XML file by building its whole tree, as before
+    iter_users_xml, for comparison.
+    """
+    with open(path, 'r') as f:
+        users = etree.parse(f).find('users')
+    return [
+        {
+            'user_id': int(user.get('id')),
+            'name': user.find('name').text,
+            'avatar': user.findtext('avatar'),
+        }
+        for user in users
+    ]
+
+
+def write_users_xml(path, count):
+    """
+    Writes synthetic users XML file with given amount of users.
+    """
+    with open(path, 'w') as xmlfile:
+        xmlfile.write('<?xml version="1.0" encoding="UTF-8" ?>\n'
+                      '<intranet>\n    <users>\n')
+        for user_id in xrange(count):
+            xmlfile.write(
+                '        <user id="%d">\n'
+                '            <avatar>/api/images/users/%d</avatar>\n'
+                '            <name>User %d.</name>\n'
+                '        </user>\n' % (user_id, user_id, user_id)
+            )
+        xmlfile.write('    </users>\n</intranet>\n')
+
+
+def peak_memory():
+    """
+    Returns peak resident set size of current process in KiB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(queue, function, args):
+    """
+    Runs function in child process and reports its time and memory growth.
+    """
+    before = peak_memory()
+    seconds = timed(function, *args)[1]
+    queue.put({'seconds': seconds, 'peak_kib': peak_memory() - before})
+
+
+def measure(function, *args):
+    """
+    Calls function in separate process and returns its run time and peak
+    memory growth, so that measurements do not affect each other.
+    """
+    queue = Queue()
+    process = Process(target=_measure, args=(queue, function, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def users_xml_parsers(count=100000):
+    """
+    Compares time and peak memory of building whole users XML tree and
+    of streaming it with iterparse, on synthetic file with 'count' users.
+    """
+    handle, path = tempfile.mkstemp(suffix='.xml')
+    os.close(handle)
+    try:
+        write_users_xml(path, count)
+        return {
+            'tree': measure(load_users_tree, path),
+            'iterparse': measure(utils.read_users_xml, path),
+        }
+    finally:
+        os.remove(path)
+
+
+def run(path, scale=100, users=100000):
+    """
+    Prints comparison of presence data layouts and parser throughput
+    for given CSV file, and of users XML parsers.
+    """
+    results = compare_layouts(path)
+    for name in ('dict', 'columnar'):
+        print '%-10s load %8.3f s  memory %10.1f KiB' % (
+            name,
+            results[name]['seconds'],
+            results[name]['bytes'] / 1024.0,
+        )
+
+    results = parse_throughput(path, scale)
+    for name in ('strptime', 'slicing'):
+        print '%-10s parse %d rows  %10.0f rows/s' % (
+            name,
+            results[name]['rows'],
+            results[name]['rows_per_second'],
+        )
+
+    results = users_xml_parsers(users)
+    for name in ('tree', 'iterparse'):
+        print '%-10s users %d  %8.3f s  peak memory +%d KiB' % (
+            name,
+            users,
+            results[name]['seconds'],
+            results[name]['peak_kib'],
+        )
+
+
+def write_presence_csv(path, users, years, seed=0):
+    """
+    Writes synthetic presence CSV file with given amount of users, each
+    present on every working day of given amount of years.
+    """
+    rand = random.Random(seed)
+    first = date.today() - timedelta(days=365 * years)
+    days = [first + timedelta(days=i) for i in xrange(365 * years)]
+    days = [day.isoformat() for day in days if day.weekday() < 5]
+    with open(path, 'w') as csvfile:
+        for user_id in xrange(users):
+            for day in days:
+                start = rand.randint(7 * 3600, 10 * 3600)
+                end = start + rand.randint(4 * 3600, 9 * 3600)
+                csvfile.write('%d,%s,%02d:%02d:%02d,%02d:%02d:%02d\n' % (
+                    user_id, day,
+                    start // 3600, start // 60 % 60, start % 60,
+                    end // 3600, end // 60 % 60, end % 60,
+                ))
+
+
+def summarize(samples):
+    """
+    Returns throughput and latency statistics of given durations.
+    """
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        'count': len(samples),
+        'throughput': len(samples) / total if total else 0.0,
+        'mean': total / len(samples) if samples else 0.0,
+        'p50': utils.percentile(samples, 50),
+        'p90': utils.percentile(samples, 90),
+        'p99': utils.percentile(samples, 99),
+    }
+
+
+def sample(function, repeat, setup=None):
+    """
+    Calls function 'repeat' times and returns list of call durations.
+    Setup function, if given, is called untimed before each call.
+    """
+    samples = []
+    for _ in xrange(repeat):
+        if setup is not None:
+            setup()
+        samples.append(timed(function)[1])
+    return samples
+
+
+def clear_caches():
+    """
+    Drops cached aggregates and responses, so that API views compute them
+    again.
+    """
+    utils.aggregates.clear()
+    utils.responses.clear()
+
+
+def api_urls(user_ids):
+    """
+    Returns names and URLs of API views to benchmark for given users.
+    """
+    user_id = user_ids[0]
+    return [
+        ('users', '/api/v1/users'),
+        ('mean_time_weekday', '/api/v1/mean_time_weekday/%d' % user_id),
+        ('presence_weekday', '/api/v1/presence_weekday/%d' % user_id),
+        ('presence_start_end', '/api/v1/presence_start_end/%d' % user_id),
+        ('distribution', '/api/v1/distribution/%d' % user_id),
+        ('distribution_all', '/api/v1/distribution'),
+        ('timeseries', '/api/v1/timeseries/week/%d' % user_id),
+        ('timeseries_all', '/api/v1/timeseries/month'),
+        ('occupancy', '/api/v1/occupancy'),
+        ('aggregate_mean', '/api/v1/aggregate/mean'),
+        ('aggregate_percentile', '/api/v1/aggregate/percentile'),
+        ('batch', '/api/v1/batch?user_id=%s' % ','.join(
+            str(user_id) for user_id in user_ids[:10]
+        )),
+        ('export', '/api/v1/export'),
+    ]
+
+
+def suite(users=100, years=2, repeat=100):
+    """
+    Benchmarks data loading, grouping and API views on synthetic data of
+    given amount of users and years.
+
+    API views are measured with empty aggregate and response caches and
+    separately with cached responses ('_cached' suffix).
+
+    Returns latency statistics of each benchmark and peak memory in KiB.
+    """
+    tmpdir = tempfile.mkdtemp()
+    csv_path = os.path.join(tmpdir, 'data.csv')
+    xml_path = os.path.join(tmpdir, 'users.xml')
+    write_presence_csv(csv_path, users, years)
+    write_users_xml(xml_path, users)
+
+    config = {
+        name: app.config.get(name) for name in ('DATA_CSV', 'USERS_XML')
+    }
+    app.config.update({'DATA_CSV': csv_path, 'USERS_XML': xml_path})
+    utils.get_data.cache_clear()
+    try:
+        results = {}
+        loads = max(1, repeat // 20)
+        results['get_data'] = summarize(sample(
+            lambda: utils.PresenceLoader(csv_path, use_snapshot=False).load(),
+            loads,
+        ))
+        results['parse_users_xml'] = summarize(sample(
+            lambda: utils.read_users_xml(xml_path), loads,
+        ))
+
+        data = utils.get_data()
+        user_ids = sorted(data)
+        rand = random.Random(0)
+        for group in (utils.group_by_weekday,
+                      utils.group_start_end_by_weekday):
+            results[group.__name__] = summarize(sample(
+                lambda group=group: group(data[rand.choice(user_ids)]),
+                repeat,
+            ))
+
+        # response body is read, so that streamed ones are generated too
+        client = app.test_client()
+        for name, url in api_urls(user_ids):
+            results['api_' + name] = summarize(sample(
+                lambda url=url: client.get(url).data, repeat, clear_caches,
+            ))
+            results['api_%s_cached' % name] = summarize(sample(
+                lambda url=url: client.get(url).data, repeat,
+            ))
+        return {
+            'users': users,
+            'years': years,
+            'results': results,
+            'peak_kib': peak_memory(),
+        }
+    finally:
+        app.config.update(config)
+        utils.get_data.cache_clear()
+        shutil.rmtree(tmpdir)
+
+
+def save_baseline(report, path):
+    """
+    Saves benchmark suite report as baseline for later comparisons.
+    """
+    with open(path, 'w') as baseline:
+        json.dump(report, baseline, indent=2, sort_keys=True)
+
+
+def regressions(report, baseline, tolerance=0.2):
+    """
+    Returns names of benchmarks whose median latency grew by more than
+    'tolerance' since baseline, with (baseline, current) medians.
+    """
+    result = {}
+    for name, stats in report['results'].iteritems():
+        before = baseline['results'].get(name)
+        if before and stats['p50'] > before['p50'] * (1 + tolerance):
+            result[name] = (before['p50'], stats['p50'])
+    return result
+
+
+def run_suite(users=100, years=2, repeat=100, baseline=None, save=False):
+    """
+    Prints benchmark suite report and compares it with baseline file.
+    Returns False when regressions were found.
+    """
+    report = suite(users, years, repeat)
+    print 'users %d  years %d  peak memory %d KiB' % (
+        users, years, report['peak_kib'],
+    )
+    print '%-26s %10s %10s %10s %10s' % (
+        'benchmark', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms',
+    )
+    for name, stats in sorted(report['results'].iteritems()):
+        print '%-26s %10.1f %10.3f %10.3f %10.3f' % (
+            name,
+            stats['throughput'],
+            stats['p50'] * 1000,
+            stats['p90'] * 1000,
+            stats['p99'] * 1000,
+        )
+
+    if not baseline:
+        return True
+    if save or not os.path.exists(baseline):
+        save_baseline(report, baseline)
+        print 'Saved baseline to %s' % baseline
+        return True
+    with open(baseline, 'r') as f:
+        found = regressions(report, json.load(f))
+    for name, (before, after) in sorted(found.iteritems()):
+        print 'REGRESSION %s: p50 %.3f ms -> %.3f ms' % (
+            name, before * 1000, after * 1000,
+        )
+    return not found
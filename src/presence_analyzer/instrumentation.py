@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request timing and profiling.
+
+Enabled with INSTRUMENTATION config option, off by default in deployment;
+request metrics exported by /metrics come from here as well, so they
+are only collected when it is on. Request latency is split into phases
+measured with phase(); time spent in nested phases is not counted in the
+outer one. With PROFILING set to 'header' requests carrying
+X-Profile header are run under cProfile, with 'all' every request is.
+"""
+
+import cProfile
+import pstats
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import wraps
+from StringIO import StringIO
+
+from flask import request
+
+from presence_analyzer.main import app
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+# amount of latencies kept per endpoint for percentiles
+RECENT = 1000
+# amount of kept profiles
+PROFILES = 20
+# amount of functions listed in profile
+PROFILE_LINES = 30
+# upper bounds of latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = threading.local()  # pylint: disable-msg=C0103
+
+
+class EndpointStats(object):
+    """
+    Latency statistics of single endpoint.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.phases = defaultdict(float)
+        self.recent = deque(maxlen=RECENT)
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, latency, phases):
+        """
+        Records latency of request and time spent in its phases.
+        """
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        self.recent.append(latency)
+        for i, bound in enumerate(BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+        for name, seconds in phases.iteritems():
+            self.phases[name] += seconds
+
+    def summary(self):
+        """
+        Returns mean, percentiles and mean phase durations in seconds.
+        """
+        recent = sorted(self.recent)
+        count = float(self.count or 1)
+        return {
+            'count': self.count,
+            'mean': self.total / count,
+            'max': self.max,
+            'p50': _rank(recent, 50),
+            'p90': _rank(recent, 90),
+            'p99': _rank(recent, 99),
+            'total': self.total,
+            'buckets': list(self.buckets),
+            'phases': {
+                name: seconds / count
+                for name, seconds in self.phases.iteritems()
+            },
+        }
+
+
+def _rank(values, q):
+    """
+    Returns q-th percentile of sorted values using nearest rank.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q / 100.0))]
+
+
+class Stats(object):
+    """
+    Statistics of all endpoints and recently captured profiles.
+    """
+
+    def __init__(self):
+        self.endpoints = defaultdict(EndpointStats)
+        self.profiles = deque(maxlen=PROFILES)
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, latency, phases):
+        """
+        Records finished request.
+        """
+        with self.lock:
+            self.endpoints[endpoint].add(latency, phases)
+
+    def add_profile(self, profile):
+        """
+        Stores captured profile.
+        """
+        with self.lock:
+            self.profiles.append(profile)
+
+    def summary(self):
+        """
+        Returns JSON serializable statistics.
+        """
+        with self.lock:
+            return {
+                'endpoints': {
+                    endpoint: stats.summary()
+                    for endpoint, stats in self.endpoints.iteritems()
+                },
+                'profiles': list(self.profiles),
+            }
+
+    def clear(self):
+        """
+        Drops all statistics.
+        """
+        with self.lock:
+            self.endpoints.clear()
+            self.profiles.clear()
+
+
+stats = Stats()  # pylint: disable-msg=C0103
+
+
+@contextmanager
+def phase(name):
+    """
+    Measures time spent in given phase of current request.
+    """
+    timings = getattr(_current, 'timings', None)
+    if timings is None:
+        yield
+        return
+
+    now = time.time()
+    stack = timings['stack']
+    if stack:
+        parent, started = stack[-1]
+        timings['phases'][parent] += now - started
+    stack.append((name, now))
+    try:
+        yield
+    finally:
+        now = time.time()
+        _, started = stack.pop()
+        timings['phases'][name] += now - started
+        if stack:
+            stack[-1] = (stack[-1][0], now)
+
+
+def timed_phase(name):
+    """
+    Counts time spent in decorated function as given phase.
+    """
+    def decorator(function):
+        @wraps(function)
+        def inner(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+        return inner
+    return decorator
+
+
+def _profiled():
+    """
+    Tells whether current request should be profiled.
+    """
+    mode = app.config.get('PROFILING')
+    return mode == 'all' or (mode == 'header' and 'X-Profile' in
+                             request.headers)
+
+
+@app.before_request
+def start_request():
+    """
+    Starts measuring current request.
+    """
+    if not app.config.get('INSTRUMENTATION'):
+        _current.timings = None
+        return
+    _current.timings = {
+        'started': time.time(),
+        'phases': defaultdict(float),
+        'stack': [],
+        'profile': None,
+    }
+    if _profiled():
+        profile = _current.timings['profile'] = cProfile.Profile()
+        profile.enable()
+
+
+@app.after_request
+def finish_request(response):
+    """
+    Records statistics of current request.
+    """
+    timings = getattr(_current, 'timings', None)
+    if timings is None:
+        return response
+    _current.timings = None
+
+    profile = timings['profile']
+    if profile is not None:
+        profile.disable()
+        output = StringIO()
+        pstats.Stats(profile, stream=output).sort_stats(
+            'cumulative'
+        ).print_stats(PROFILE_LINES)
+        profile_id = '%s-%d' % (request.endpoint, timings['started'] * 1000)
+        stats.add_profile({
+            'id': profile_id,
+            'url': request.full_path,
+            'profile': output.getvalue(),
+        })
+        response.headers['X-Profile-Id'] = profile_id
+
+    latency = time.time() - timings['started']
+    phases = dict(timings['phases'])
+    stats.add(request.endpoint, latency, phases)
+    response.headers['Server-Timing'] = ', '.join(
+        '%s;dur=%.3f' % (name, seconds * 1000)
+        for name, seconds in sorted(phases.iteritems())
+    )
+    return response
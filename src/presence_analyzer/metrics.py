@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics in Prometheus text exposition format.
+"""
+
+import resource
+import threading
+
+from presence_analyzer import instrumentation, utils
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def resident_memory():
+    """
+    Returns resident set size of current process in bytes. Falls back to
+    peak size where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize()
+    except (EnvironmentError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _labels(labels):
+    """
+    Formats labels of sample.
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+
+
+class Metrics(object):
+    """
+    Collects metric families and renders them as text.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, kind, help_text, samples):
+        """
+        Adds metric family with (suffix, labels, value) samples, where
+        labels are (name, value) pairs.
+        """
+        self.lines.append('# HELP %s %s' % (name, help_text))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            self.lines.append('%s%s%s %r' % (
+                name, suffix, _labels(labels), float(value),
+            ))
+
+    def render(self):
+        """
+        Returns metrics in text exposition format.
+        """
+        return '\n'.join(self.lines) + '\n'
+
+
+def _loader_metrics(metrics):
+    """
+    Adds presence data loader metrics.
+    """
+    stats = utils.loader_stats()
+    if stats is None:
+        return
+    metrics.add('presence_data_load_seconds', 'gauge',
+                'Duration of the last presence data load.',
+                [('', (), stats['load_seconds'])])
+    metrics.add('presence_data_loads_total', 'counter',
+                'Presence data loads which parsed new data.',
+                [('', (), stats['loads'])])
+    metrics.add('presence_data_rows', 'gauge',
+                'Presence entries currently loaded.',
+                [('', (), stats['rows'])])
+    metrics.add('presence_data_users', 'gauge',
+                'Users with presence entries currently loaded.',
+                [('', (), stats['users'])])
+    metrics.add('presence_csv_rejected_lines', 'gauge',
+                'Malformed lines skipped in presence CSV files.',
+                [('', (), stats['rejected'])])
+
+
+def _cache_metrics(metrics):
+    """
+    Adds statistics of data and response caches.
+    """
+    caches = [
+        ('get_data', utils.get_data.cache_info()),
+        ('aggregates', utils.aggregates.info()),
+        ('responses', utils.responses.info()),
+    ]
+    for name in ('hits', 'misses'):
+        metrics.add('presence_cache_%s_total' % name, 'counter',
+                    'Cache %s.' % name,
+                    [('', [('cache', cache)], info[name])
+                     for cache, info in caches])
+    info = caches[0][1]
+    metrics.add('presence_cache_stale_total', 'counter',
+                'Stale cached values served while being refreshed.',
+                [('', [('cache', 'get_data')], info['stale'])])
+    metrics.add('presence_cache_refresh_errors_total', 'counter',
+                'Failed background refreshes of cached values.',
+                [('', [('cache', 'get_data')], info['refresh_errors'])])
+    metrics.add('presence_cache_age_seconds', 'gauge',
+                'Age of the oldest cached value.',
+                [('', [('cache', 'get_data')], info['age'])])
+    metrics.add('presence_cache_entries', 'gauge',
+                'Values held in cache.',
+                [('', [('cache', cache)], info['size'])
+                 for cache, info in caches[1:]])
+
+
+def _request_metrics(metrics):
+    """
+    Adds per-endpoint request counts and latency histograms.
+    """
+    endpoints = sorted(
+        instrumentation.stats.summary()['endpoints'].iteritems()
+    )
+    metrics.add('presence_requests_total', 'counter',
+                'Handled requests.',
+                [('', [('endpoint', endpoint)], stats['count'])
+                 for endpoint, stats in endpoints])
+
+    samples = []
+    for endpoint, stats in endpoints:
+        for bound, count in zip(instrumentation.BUCKETS, stats['buckets']):
+            samples.append(('_bucket', [('endpoint', endpoint),
+                                        ('le', repr(bound))], count))
+        samples.extend([
+            ('_bucket', [('endpoint', endpoint), ('le', '+Inf')],
+             stats['count']),
+            ('_sum', [('endpoint', endpoint)], stats['total']),
+            ('_count', [('endpoint', endpoint)], stats['count']),
+        ])
+    metrics.add('presence_request_duration_seconds', 'histogram',
+                'Request latency.', samples)
+
+    metrics.add('presence_request_phase_seconds_total', 'counter',
+                'Time spent in request phases.',
+                [('', [('endpoint', endpoint), ('phase', name)],
+                  seconds * stats['count'])
+                 for endpoint, stats in endpoints
+                 for name, seconds in sorted(stats['phases'].iteritems())])
+
+
+def render():
+    """
+    Returns current metrics in Prometheus text format.
+    """
+    metrics = Metrics()
+    _loader_metrics(metrics)
+    _cache_metrics(metrics)
+    _request_metrics(metrics)
+    metrics.add('process_resident_memory_bytes', 'gauge',
+                'Resident memory size in bytes.',
+                [('', (), resident_memory())])
+    metrics.add('process_threads', 'gauge',
+                'Threads of the process, including server worker threads.',
+                [('', (), threading.active_count())])
+    return metrics.render()
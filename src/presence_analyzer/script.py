@@ -27,10 +27,21 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, warmup=True):
+    from presence_analyzer import app, utils
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    utils.aggregates.configure(
+        app.config.get('AGGREGATE_CACHE_SIZE', 1024),
+        app.config.get('AGGREGATE_CACHE_TTL', 600),
+    )
+    utils.responses.configure(
+        app.config.get('RESPONSE_CACHE_SIZE', 1024),
+        app.config.get('AGGREGATE_CACHE_TTL', 600),
+    )
+    # command line actions load data themselves, if they need it
+    if warmup and app.config.get('WARMUP') and utils.warmup.state == 'idle':
+        utils.warmup.start()
     return app
 
 
@@ -45,7 +56,7 @@ def make_debug(global_conf={}, **conf):
 def make_shell():
     """Interactive Flask Shell"""
     from flask import request
-    app = make_app()
+    app = make_app(warmup=False)
     http = app.test_client()
     reqctx = app.test_request_context
     return locals()
@@ -111,6 +122,82 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl benchmark
+    def action_benchmark(path=('p', ''), scale=100, users=100000):
+        """Benchmark loading of presence data and users.
+
+        Compares load time and memory of presence data layouts, CSV
+        parsing throughput and users XML parsers.
+
+        Options:
+         - '--path' CSV file to load, defaults to DATA_CSV
+         - '--scale' how many times to repeat the file for parsing speed
+         - '--users' amount of users in synthetic users XML file
+        """
+        from presence_analyzer import benchmark
+        app = make_app(warmup=False)
+        benchmark.run(path or app.config['DATA_CSV'], scale, users)
+
+    # bin/flask-ctl benchmark_suite
+    def action_benchmark_suite(users=100, years=2, repeat=100,
+                               baseline=('b', ''), save=False):
+        """Benchmark data layer and API views on synthetic data.
+
+        Options:
+         - '--users' amount of users in generated data
+         - '--years' amount of years of presence of each user
+         - '--repeat' how many times to call each benchmarked function
+         - '--baseline' JSON file with results to compare with; it is
+           written when it does not exist
+         - '--save' overwrite baseline with current results
+        """
+        from presence_analyzer import benchmark
+        if not benchmark.run_suite(users, years, repeat, baseline, save):
+            sys.exit(1)
+
+    # bin/flask-ctl snapshot
+    def action_snapshot():
+        """Write binary snapshot of presence data and users.
+
+        Workers load the snapshot instead of parsing DATA_CSV and
+        USERS_XML when it is up to date.
+        """
+        from presence_analyzer import utils
+        make_app(warmup=False)
+        print utils.write_snapshot()
+
+    # bin/flask-ctl data_service
+    def action_data_service(interval=5):
+        """Keep snapshot of presence data and users up to date.
+
+        Run once per host, so that web workers with STORAGE = 'snapshot'
+        share the data mapped from the snapshot instead of each parsing
+        DATA_CSV and USERS_XML.
+
+        Options:
+         - '--interval' seconds between checks for changes
+        """
+        from presence_analyzer import utils
+        app = make_app(warmup=False)
+        utils.DataService(
+            app.config['DATA_CSV'], app.config['USERS_XML']
+        ).serve(interval)
+
+    # bin/flask-ctl import_sqlite
+    def action_import_sqlite(path=('p', '')):
+        """Import presence CSV file into SQLite database.
+
+        The database is used instead of DATA_CSV with STORAGE = 'sqlite'.
+
+        Options:
+         - '--path' CSV file to import, defaults to DATA_CSV
+        """
+        from presence_analyzer import utils
+        app = make_app(warmup=False)
+        print utils.import_sqlite(
+            path or app.config['DATA_CSV'], app.config['DATA_SQLITE']
+        )
+
     werkzeug.script.run()
 
 
@@ -119,7 +206,7 @@ def get_users():
     """
     Get users XML file.
     """
-    app = make_app(config=DEPLOY_CFG)
+    app = make_app(config=DEPLOY_CFG, warmup=False)
     xml_url = app.config['USERS_XML_URL']
     xml_path = app.config['USERS_XML']
     data = urllib2.urlopen(xml_url)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshot of parsed presence data and users.
+
+Snapshot is a columnar file which is memory-mapped when loaded, so all
+worker processes reading it share the same pages. Layout:
+
+    header      magic, version, metadata length, user and row count
+    metadata    JSON with source file state and users list
+    user table  (user_id, first row, row count) int32 triples
+    index       WeekdayIndex totals of all users as native longs
+    occupancy   Occupancy changes of all users as int32 column
+    rollups     (first week, weeks, first month, months) int32 quadruples
+                of all users, followed by their Rollup counts and totals
+    columns     days, starts and ends of all users as int32 columns
+    values      WeekdayValues runs of all users as int32 column
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from presence_analyzer.store import (
+    PresenceStore,
+    TYPECODE,
+    Occupancy,
+    UserPresence,
+    WeekdayIndex,
+    WeekdayValues,
+)
+
+MAGIC = 'PRESNAP\0'
+VERSION = 6
+HEADER = struct.Struct('<8sHIII')
+ALIGNMENT = 8
+
+# amount of values unpacked at once when iterating over mapped column
+CHUNK = 4096
+
+
+class SnapshotError(Exception):
+    """
+    Snapshot file is corrupted or was written by incompatible version.
+    """
+
+
+def snapshot_path(csv_path):
+    """
+    Returns path of snapshot of given presence CSV file.
+    """
+    return csv_path + '.snapshot'
+
+
+def _align(offset):
+    """
+    Rounds offset up to ALIGNMENT.
+    """
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class MappedColumn(object):
+    """
+    Read-only int32 column stored in memory-mapped file.
+    """
+    __slots__ = ('buf', 'offset', 'length')
+
+    item = struct.Struct('=' + TYPECODE)
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            if step != 1:
+                return array(TYPECODE, self)[i]
+            column = array(TYPECODE)
+            if start < stop:
+                column.fromstring(self.buf[
+                    self.offset + self.item.size * start:
+                    self.offset + self.item.size * stop
+                ])
+            return column
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('column index out of range')
+        return self.item.unpack_from(
+            self.buf, self.offset + self.item.size * i)[0]
+
+    def __iter__(self):
+        for start in xrange(0, self.length, CHUNK):
+            size = min(CHUNK, self.length - start)
+            chunk = struct.unpack_from(
+                '=%d%s' % (size, TYPECODE),
+                self.buf,
+                self.offset + self.item.size * start,
+            )
+            for value in chunk:
+                yield value
+
+
+def write(path, data, users, meta=None):
+    """
+    Atomically writes snapshot of PresenceStore and users list.
+
+    Metadata can hold additional JSON serializable information about
+    sources of the data.
+    """
+    table = array(TYPECODE)
+    index = array('l')
+    occupancy = array(TYPECODE)
+    rollup_table = array(TYPECODE)
+    rollups = array(TYPECODE)
+    columns = [array(TYPECODE), array(TYPECODE), array(TYPECODE)]
+    values = array(TYPECODE)
+    for user_id in sorted(data):
+        user = data[user_id]
+        table.extend((user_id, len(columns[0]), len(user)))
+        for name in WeekdayIndex.__slots__:
+            index.extend(getattr(user.index, name))
+        occupancy.extend(user.occupancy.changes)
+        for rollup in (user.weeks, user.months):
+            rollup_table.extend((rollup.first, len(rollup.counts)))
+            rollups.extend(rollup.counts)
+            rollups.extend(rollup.totals)
+        columns[0].extend(user.days)
+        columns[1].extend(user.starts)
+        columns[2].extend(user.ends)
+        for run in user.values.runs:
+            values.extend(run)
+
+    meta = dict(meta or {})
+    meta.update({
+        'byteorder': sys.byteorder,
+        'itemsize': [table.itemsize, index.itemsize],
+        'users': users,
+    })
+    meta = json.dumps(meta)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        # mkstemp creates file readable only by owner, while workers may
+        # run as other users
+        os.fchmod(handle, 0o644)
+        with os.fdopen(handle, 'wb') as snapshot:
+            snapshot.write(HEADER.pack(
+                MAGIC, VERSION, len(meta), len(data), len(columns[0])
+            ))
+            snapshot.write(meta)
+            parts = [
+                table, index, occupancy, rollup_table, rollups,
+            ]
+            for part in parts + columns + [values]:
+                snapshot.write('\0' * (_align(snapshot.tell()) -
+                                       snapshot.tell()))
+                part.tofile(snapshot)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_header(path, snapshot):
+    """
+    Reads header and metadata of snapshot from given file object.
+    Returns (metadata, user count, row count, offset of user table).
+    """
+    header = snapshot.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise SnapshotError('%s is too short' % path)
+    magic, version, meta_length, user_count, row_count = \
+        HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise SnapshotError('%s has unsupported format' % path)
+
+    meta = json.loads(snapshot.read(meta_length))
+    if (meta['byteorder'] != sys.byteorder or
+            meta['itemsize'] != [array(TYPECODE).itemsize,
+                                 array('l').itemsize]):
+        raise SnapshotError('%s was written on other platform' % path)
+    return meta, user_count, row_count, _align(HEADER.size + meta_length)
+
+
+def read_meta(path):
+    """
+    Returns metadata of snapshot without mapping its data.
+    """
+    with open(path, 'rb') as snapshot:
+        return _read_header(path, snapshot)[0]
+
+
+def read(path):
+    """
+    Maps snapshot file and returns (PresenceStore, metadata).
+
+    Users list is available in metadata under 'users' key.
+    """
+    with open(path, 'rb') as snapshot:
+        meta, user_count, row_count, offset = _read_header(path, snapshot)
+        buf = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+    table = array(TYPECODE)
+    index = array('l')
+    size = 3 * user_count * table.itemsize
+    table.fromstring(buf[offset:offset + size])
+    offset = _align(offset + size)
+    size = 28 * user_count * index.itemsize
+    index.fromstring(buf[offset:offset + size])
+    offset = _align(offset + size)
+    occupancy_size = len(Occupancy().changes)
+    occupancy = offset
+    offset = _align(offset + user_count * occupancy_size * table.itemsize)
+    rollup_table = array(TYPECODE)
+    size = 4 * user_count * table.itemsize
+    rollup_table.fromstring(buf[offset:offset + size])
+    offset = _align(offset + size)
+    rollups = array(TYPECODE)
+    size = 2 * sum(rollup_table[1::2]) * table.itemsize
+    rollups.fromstring(buf[offset:offset + size])
+    offset = _align(offset + size)
+    column_size = _align(row_count * table.itemsize)
+    values = offset + 3 * column_size
+    if len(buf) < values + 3 * row_count * table.itemsize:
+        raise SnapshotError('%s is truncated' % path)
+
+    data = PresenceStore()
+    position = 0
+    for i in xrange(user_count):
+        user_id, first, length = table[3 * i:3 * i + 3]
+        user = UserPresence()
+        user.days, user.starts, user.ends = [
+            MappedColumn(
+                buf,
+                offset + n * column_size + table.itemsize * first,
+                length,
+            )
+            for n in range(3)
+        ]
+        for n, name in enumerate(WeekdayIndex.__slots__):
+            start = 28 * i + 7 * n
+            setattr(user.index, name, index[start:start + 7])
+        # runs of each field have as many values as there are entries on
+        # each weekday
+        start = values + table.itemsize * 3 * first
+        runs = []
+        for size in list(user.index.counts) * len(WeekdayValues.FIELDS):
+            runs.append(MappedColumn(buf, start, size))
+            start += table.itemsize * size
+        user.values.runs = runs
+        user.occupancy.changes = MappedColumn(
+            buf,
+            occupancy + table.itemsize * occupancy_size * i,
+            occupancy_size,
+        )
+        for n, rollup in enumerate((user.weeks, user.months)):
+            rollup.first, buckets = rollup_table[4 * i + 2 * n:
+                                                 4 * i + 2 * n + 2]
+            rollup.counts = rollups[position:position + buckets]
+            rollup.totals = rollups[position + buckets:
+                                    position + 2 * buckets]
+            position += 2 * buckets
+        data[user_id] = user
+    return data, meta
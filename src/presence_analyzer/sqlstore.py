@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite storage of presence data.
+
+SQLiteStore offers the same interface as PresenceStore, but aggregates
+like weekday totals, histograms, occupancy and rollups are computed by
+SQL queries using (user_id, day) index, so presence entries are never
+loaded into memory as a whole.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date
+
+from presence_analyzer.store import (
+    BIN_SECONDS,
+    BINS,
+    Occupancy,
+    Rollup,
+    SLOT_SECONDS,
+    SLOTS,
+    TYPECODE,
+    WeekdayHistogram,
+    WeekdayIndex,
+    month,
+    new_generation,
+    time_from_seconds,
+)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS presence_user_day
+    ON presence (user_id, day);
+"""
+
+# maximal amount of user ids bound in single query
+CHUNK = 500
+
+WEEKDAY = '(day - 1) % 7'
+INTERVAL = 'end_time - start_time'
+
+
+def connect(path):
+    """
+    Opens database and creates presence table if missing.
+    """
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def import_rows(path, rows):
+    """
+    Adds (user_id, day ordinal, start, end) rows to database. Rows for
+    already known days replace the old ones. Returns amount of rows.
+    """
+    connection = connect(path)
+    try:
+        with connection:
+            cursor = connection.executemany(
+                'INSERT OR REPLACE INTO presence '
+                '(user_id, day, month, start_time, end_time) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (
+                    (user_id, day, month(day), start, end)
+                    for user_id, day, start, end in rows
+                ),
+            )
+            return cursor.rowcount
+    finally:
+        connection.close()
+
+
+def _where(user_ids=None, first=None, last=None):
+    """
+    Returns WHERE clause and its parameters limiting rows to given users
+    and day ordinals.
+    """
+    conditions = []
+    params = []
+    if user_ids is not None:
+        conditions.append('user_id IN (%s)' % ','.join('?' * len(user_ids)))
+        params.extend(user_ids)
+    if first is not None:
+        conditions.append('day >= ?')
+        params.append(first)
+    if last is not None:
+        conditions.append('day <= ?')
+        params.append(last)
+    if not conditions:
+        return '', params
+    return 'WHERE ' + ' AND '.join(conditions), params
+
+
+class SQLiteStore(object):
+    """
+    Presence data of all users kept in SQLite database: maps user_id to
+    SQLiteUser.
+
+    Like PresenceStore it has generation, version and modified attributes.
+    Each thread uses its own connection.
+    """
+
+    def __init__(self, path, version=None, modified=None):
+        self.path = path
+        self.generation = new_generation()
+        self.version = version
+        self.modified = modified
+        self.local = threading.local()
+        self.users = {}
+        self.lock = threading.Lock()
+        self.user_ids = [
+            user_id for user_id, in self.execute(
+                'SELECT DISTINCT user_id FROM presence ORDER BY user_id'
+            )
+        ]
+
+    def execute(self, query, params=()):
+        """
+        Runs query with connection of current thread and returns cursor.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = connect(self.path)
+        return connection.execute(query, params)
+
+    def query(self, query, user_ids=None, first=None, last=None):
+        """
+        Runs query with '{where}' placeholder for WHERE clause limiting
+        rows to given users and day ordinals. Iterates over result rows.
+
+        User ids are bound in chunks, so the query runs once per chunk,
+        and not at all for empty list of users.
+        """
+        if user_ids is not None and len(user_ids) >= len(self.user_ids) \
+                and set(user_ids) >= set(self.user_ids):
+            user_ids = None
+        if user_ids is None:
+            chunks = [None]
+        else:
+            user_ids = list(user_ids)
+            chunks = [
+                user_ids[i:i + CHUNK] for i in xrange(0, len(user_ids), CHUNK)
+            ]
+        for chunk in chunks:
+            where, params = _where(chunk, first, last)
+            for row in self.execute(query.format(where=where), params):
+                yield row
+
+    def weekday_index(self, user_ids=None, first=None, last=None):
+        """
+        Returns WeekdayIndex of entries of given users (all by default)
+        between given day ordinals.
+        """
+        index = WeekdayIndex()
+        for i, count, interval, start, end in self.query(
+                'SELECT %s, count(*), sum(%s), sum(start_time), '
+                'sum(end_time) FROM presence {where} GROUP BY 1'
+                % (WEEKDAY, INTERVAL),
+                user_ids, first, last):
+            index.counts[i] += count
+            index.intervals[i] += interval
+            index.starts[i] += start
+            index.ends[i] += end
+        return index
+
+    def weekday_histogram(self, user_ids=None, first=None, last=None):
+        """
+        Returns WeekdayHistogram of entries of given users (all by default)
+        between given day ordinals.
+        """
+        histogram = WeekdayHistogram()
+        for n, value in enumerate(('start_time', 'end_time', INTERVAL)):
+            for i, bin_, count in self.query(
+                    'SELECT %s, min(max(%s, 0) / %d, %d), count(*) '
+                    'FROM presence {where} GROUP BY 1, 2'
+                    % (WEEKDAY, value, BIN_SECONDS, BINS - 1),
+                    user_ids, first, last):
+                histogram.bins[(n * 7 + i) * BINS + bin_] += count
+        return histogram
+
+    def weekday_occupancy(self, user_ids=None, first=None, last=None):
+        """
+        Returns Occupancy of entries of given users (all by default)
+        between given day ordinals.
+        """
+        occupancy = Occupancy()
+        for slot, sign in (('start_time / %d' % SLOT_SECONDS, 1),
+                           ('(end_time - 1) / %d + 1' % SLOT_SECONDS, -1)):
+            # empty entries are not counted, as in Occupancy.add
+            for i, slot_, count in self.query(
+                    'SELECT %s, %s, sum(end_time > start_time) '
+                    'FROM presence {where} GROUP BY 1, 2' % (WEEKDAY, slot),
+                    user_ids, first, last):
+                occupancy.changes[i * (SLOTS + 1) + slot_] += sign * count
+        return occupancy
+
+    def rollup(self, period, user_ids=None):
+        """
+        Returns Rollup of entries of given users (all by default) per
+        'week' or 'month'.
+        """
+        bucket = '(day - 1) / 7' if period == 'week' else 'month'
+        rollup = Rollup()
+        for number, count, total in self.query(
+                'SELECT %s, count(*), sum(%s) FROM presence {where} '
+                'GROUP BY 1 ORDER BY 1' % (bucket, INTERVAL),
+                user_ids):
+            rollup.add_totals(number, count, total)
+        return rollup
+
+    def sorted_values(self, field, user_ids=None, first=None, last=None):
+        """
+        Returns sorted values of given field ('starts', 'ends' or
+        'intervals') of entries of given users (all by default) between
+        given day ordinals: list of sorted runs for each weekday.
+        """
+        value = {
+            'starts': 'start_time',
+            'ends': 'end_time',
+        }.get(field, INTERVAL)
+        result = [[] for _ in range(7)]
+        for i, item in self.query(
+                'SELECT %s, %s FROM presence {where} ORDER BY 1, 2'
+                % (WEEKDAY, value),
+                user_ids, first, last):
+            runs = result[i]
+            # each chunk of users is sorted separately, its values start
+            # a new run
+            if not runs or item < runs[-1][-1]:
+                runs.append(array(TYPECODE))
+            runs[-1].append(item)
+        return result
+
+    def day_range(self, user_ids=None):
+        """
+        Returns ordinals of the first and the last day with entries of
+        given users (all by default), or (0, -1) if there are none.
+        """
+        days = [
+            row for row in self.query(
+                'SELECT min(day), max(day) FROM presence {where}', user_ids
+            )
+            if row[0] is not None
+        ]
+        if not days:
+            return 0, -1
+        return min(row[0] for row in days), max(row[1] for row in days)
+
+    def row_count(self):
+        """
+        Returns total amount of presence entries.
+        """
+        return self.execute('SELECT count(*) FROM presence').fetchone()[0]
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __iter__(self):
+        return iter(self.user_ids)
+
+    def __contains__(self, user_id):
+        pos = bisect_left(self.user_ids, user_id)
+        return pos < len(self.user_ids) and self.user_ids[pos] == user_id
+
+    def __getitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        with self.lock:
+            user = self.users.get(user_id)
+            if user is None:
+                user = self.users[user_id] = SQLiteUser(self, user_id)
+        return user
+
+    def keys(self):
+        """
+        Returns list of user ids.
+        """
+        return list(self.user_ids)
+
+    def iterkeys(self):
+        """
+        Iterates over user ids.
+        """
+        return iter(self.user_ids)
+
+    def itervalues(self):
+        """
+        Iterates over users.
+        """
+        return (self[user_id] for user_id in self.user_ids)
+
+    def iteritems(self):
+        """
+        Iterates over (user_id, user) pairs.
+        """
+        return ((user_id, self[user_id]) for user_id in self.user_ids)
+
+
+class SQLiteUser(object):
+    """
+    Presence entries of a single user kept in SQLite database, with the
+    interface of UserPresence.
+
+    Aggregates of all entries and the columns are queried on first use
+    and kept as long as the store.
+    """
+
+    def __init__(self, store, user_id):
+        self.store = store
+        self.user_id = user_id
+        self.cached = {}
+
+    def _cached(self, name, compute):
+        """
+        Returns value computed once by compute().
+        """
+        if name not in self.cached:
+            self.cached[name] = compute()
+        return self.cached[name]
+
+    def _columns(self):
+        """
+        Returns days, starts and ends columns sorted by day.
+        """
+        def compute():
+            columns = array(TYPECODE), array(TYPECODE), array(TYPECODE)
+            for row in self.store.query(
+                    'SELECT day, start_time, end_time FROM presence {where} '
+                    'ORDER BY day', [self.user_id]):
+                for column, value in zip(columns, row):
+                    column.append(value)
+            return columns
+        return self._cached('columns', compute)
+
+    @property
+    def days(self):
+        """
+        Day ordinals of the entries.
+        """
+        return self._columns()[0]
+
+    @property
+    def starts(self):
+        """
+        Starts of the entries in seconds since midnight.
+        """
+        return self._columns()[1]
+
+    @property
+    def ends(self):
+        """
+        Ends of the entries in seconds since midnight.
+        """
+        return self._columns()[2]
+
+    @property
+    def index(self):
+        """
+        WeekdayIndex of all entries.
+        """
+        return self._cached('index', self.weekday_index)
+
+    @property
+    def occupancy(self):
+        """
+        Occupancy of all entries.
+        """
+        return self._cached('occupancy', self.weekday_occupancy)
+
+    @property
+    def weeks(self):
+        """
+        Rollup of entries per ISO week.
+        """
+        return self._cached(
+            'weeks', lambda: self.store.rollup('week', [self.user_id])
+        )
+
+    @property
+    def months(self):
+        """
+        Rollup of entries per month.
+        """
+        return self._cached(
+            'months', lambda: self.store.rollup('month', [self.user_id])
+        )
+
+    def weekday_index(self, first=None, last=None):
+        """
+        Returns WeekdayIndex of entries between given day ordinals.
+        """
+        return self.store.weekday_index([self.user_id], first, last)
+
+    def weekday_histogram(self, first=None, last=None):
+        """
+        Returns WeekdayHistogram of entries between given day ordinals.
+        """
+        return self.store.weekday_histogram([self.user_id], first, last)
+
+    def weekday_occupancy(self, first=None, last=None):
+        """
+        Returns Occupancy of entries between given day ordinals.
+        """
+        return self.store.weekday_occupancy([self.user_id], first, last)
+
+    def rows(self, first=None, last=None):
+        """
+        Iterates over (day, start, end) tuples sorted by day, optionally
+        only between given day ordinals (inclusive).
+        """
+        return self.store.query(
+            'SELECT day, start_time, end_time FROM presence {where} '
+            'ORDER BY day', [self.user_id], first, last,
+        )
+
+    def span(self, first=None, last=None):
+        """
+        Returns (lo, hi) slice bounds of entries between given day
+        ordinals (inclusive).
+        """
+        days = self.days
+        lo = 0 if first is None else bisect_left(days, first)
+        hi = len(days) if last is None else bisect_right(days, last)
+        return lo, max(lo, hi)
+
+    def __len__(self):
+        return sum(self.index.counts)
+
+    def __iter__(self):
+        return (date.fromordinal(day) for day in self.days)
+
+    def __contains__(self, item):
+        try:
+            self[item]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, item):
+        try:
+            day = item.toordinal()
+        except AttributeError:
+            raise KeyError(item)
+        row = self.store.execute(
+            'SELECT start_time, end_time FROM presence '
+            'WHERE user_id = ? AND day = ?', (self.user_id, day),
+        ).fetchone()
+        if row is None:
+            raise KeyError(item)
+        return {
+            'start': time_from_seconds(row[0]),
+            'end': time_from_seconds(row[1]),
+        }
+
+    def keys(self):
+        """
+        Returns list of dates the user was present.
+        """
+        return list(self)
+
+
+class SQLiteLoader(object):
+    """
+    Opens SQLiteStore of presence database again whenever the database
+    file changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.state = None
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Returns SQLiteStore with current content of the database.
+        """
+        with self.lock:
+            started = time.time()
+            stats = [os.stat(self.path)]
+            if os.path.exists(self.path + '-wal'):
+                stats.append(os.stat(self.path + '-wal'))
+            state = [(stat.st_ino, stat.st_size, stat.st_mtime)
+                     for stat in stats]
+            if state != self.state:
+                modified = max(stat.st_mtime for stat in stats)
+                self.data = SQLiteStore(
+                    self.path,
+                    version='-'.join('%x-%x-%r' % item for item in state),
+                    modified=modified,
+                )
+                self.state = state
+                self.loads += 1
+                self.load_seconds = time.time() - started
+                log.debug('Opened %s', self.path)
+            return self.data
+
+    def stats(self):
+        """
+        Returns amount of loads, duration of the last one, and amounts of
+        rows and users. Malformed lines are rejected when importing, so
+        none are counted here.
+        """
+        with self.lock:
+            data = self.data
+            return {
+                'loads': self.loads,
+                'load_seconds': self.load_seconds,
+                'rows': data.row_count() if data else 0,
+                'users': len(data) if data else 0,
+                'rejected': 0,
+            }
@@ -0,0 +1,762 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar presence data store.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from datetime import date, time
+from itertools import chain, count, imap, izip
+from operator import add
+
+# Typecode of the columns: 32-bit signed integers are enough both for day
+# ordinals (~735000 for current dates) and for seconds since midnight.
+TYPECODE = 'i'
+
+# Width of histogram bins in seconds and amount of bins covering a day.
+BIN_SECONDS = 600
+BINS = 24 * 3600 // BIN_SECONDS
+
+# Length of occupancy slots in seconds and amount of slots covering a day.
+SLOT_SECONDS = 900
+SLOTS = 24 * 3600 // SLOT_SECONDS
+
+
+def weekday(day):
+    """
+    Returns weekday (Monday is 0) of given day ordinal.
+    """
+    return (day - 1) % 7
+
+
+def week(day):
+    """
+    Returns number of ISO week (starting on Monday) of given day ordinal,
+    counted from the first week of year 1.
+    """
+    return (day - 1) // 7
+
+
+# month numbers of already seen day ordinals, data spans few thousands of
+# days at most
+_months = {}
+
+
+def month(day):
+    """
+    Returns number of month of given day ordinal, counted from January of
+    year 0.
+    """
+    try:
+        return _months[day]
+    except KeyError:
+        value = date.fromordinal(day)
+        number = _months[day] = value.year * 12 + value.month - 1
+        return number
+
+
+def time_from_seconds(seconds):
+    """
+    Creates datetime.time object from amount of seconds since midnight.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class WeekdayIndex(object):
+    """
+    Per-weekday totals of user presence: amount of entries and sums of
+    intervals, starts and ends, in seconds.
+    """
+    __slots__ = ('counts', 'intervals', 'starts', 'ends')
+
+    def __init__(self):
+        self.counts = array('l', [0] * 7)
+        self.intervals = array('l', [0] * 7)
+        self.starts = array('l', [0] * 7)
+        self.ends = array('l', [0] * 7)
+
+    def add(self, day, start, end, sign=1):
+        """
+        Adds entry to the totals, or subtracts it when sign is -1.
+        """
+        i = weekday(day)
+        self.counts[i] += sign
+        self.intervals[i] += sign * (end - start)
+        self.starts[i] += sign * start
+        self.ends[i] += sign * end
+
+    def copy(self):
+        """
+        Returns independent copy of totals.
+        """
+        index = WeekdayIndex()
+        for name in self.__slots__:
+            setattr(index, name, array('l', getattr(self, name)))
+        return index
+
+    def update(self, other):
+        """
+        Adds totals of other index to this one.
+        """
+        for name in self.__slots__:
+            setattr(self, name, array('l', imap(
+                add, getattr(self, name), getattr(other, name)
+            )))
+
+    def mean(self, totals, i):
+        """
+        Returns mean of given totals for i-th weekday. Zero if there are no
+        entries.
+        """
+        count = self.counts[i]
+        return float(totals[i]) / count if count > 0 else 0
+
+
+def _bin(seconds):
+    """
+    Returns histogram bin of given amount of seconds.
+    """
+    return min(max(seconds, 0) // BIN_SECONDS, BINS - 1)
+
+
+def select(runs, k):
+    """
+    Returns k-th (counted from zero) smallest value of several sorted
+    sequences of integers. The value is found by bisecting range of values,
+    so the sequences are neither merged nor iterated over.
+    """
+    runs = [run for run in runs if len(run)]
+    if len(runs) == 1:
+        return runs[0][k]
+    lo = min(run[0] for run in runs)
+    hi = max(run[-1] for run in runs)
+    # the smallest value with more than k values not greater than it
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if sum(bisect_right(run, mid) for run in runs) > k:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+class WeekdayValues(object):
+    """
+    Per-weekday sorted values of user presence starts, ends and intervals,
+    in seconds.
+
+    Sorted values of n-th field of FIELDS for given weekday are kept in
+    runs[n * 7 + weekday].
+    """
+    __slots__ = ('runs',)
+
+    FIELDS = ('starts', 'ends', 'intervals')
+
+    def __init__(self):
+        self.runs = [array(TYPECODE) for _ in range(len(self.FIELDS) * 7)]
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Creates values of given (day, start, end) rows, sorting them at once.
+        """
+        runs = [[] for _ in range(len(cls.FIELDS) * 7)]
+        for day, start, end in rows:
+            i = weekday(day)
+            runs[i].append(start)
+            runs[7 + i].append(end)
+            runs[14 + i].append(end - start)
+        values = cls()
+        values.runs = [array(TYPECODE, sorted(run)) for run in runs]
+        return values
+
+    def add(self, day, start, end, sign=1):
+        """
+        Inserts values of entry keeping them sorted, or removes them when
+        sign is -1.
+        """
+        i = weekday(day)
+        for offset, value in ((i, start), (7 + i, end), (14 + i, end - start)):
+            run = self.runs[offset]
+            if sign > 0:
+                insort(run, value)
+            else:
+                del run[bisect_left(run, value)]
+
+    def copy(self):
+        """
+        Returns independent copy of values.
+        """
+        values = WeekdayValues()
+        values.runs = [array(TYPECODE, run) for run in self.runs]
+        return values
+
+    def get(self, field, i):
+        """
+        Returns sorted values of given field for i-th weekday.
+        """
+        return self.runs[self.FIELDS.index(field) * 7 + i]
+
+
+class WeekdayHistogram(object):
+    """
+    Per-weekday histograms of user presence starts, ends and intervals,
+    with BINS bins BIN_SECONDS wide each.
+
+    Counts are kept in single array, histogram of n-th field of FIELDS for
+    given weekday starts at (n * 7 + weekday) * BINS.
+    """
+    __slots__ = ('bins',)
+
+    FIELDS = ('starts', 'ends', 'intervals')
+
+    def __init__(self):
+        self.bins = array(TYPECODE, [0]) * (len(self.FIELDS) * 7 * BINS)
+
+    def add(self, day, start, end, sign=1):
+        """
+        Adds entry to the histograms, or subtracts it when sign is -1.
+        """
+        offset = weekday(day) * BINS
+        bins = self.bins
+        bins[offset + _bin(start)] += sign
+        bins[7 * BINS + offset + _bin(end)] += sign
+        bins[14 * BINS + offset + _bin(end - start)] += sign
+
+    def update(self, other):
+        """
+        Adds counts of other histograms to this one.
+        """
+        self.bins = array(TYPECODE, imap(add, self.bins, other.bins))
+
+    def add_values(self, values):
+        """
+        Adds counts of WeekdayValues. As the values are sorted, each
+        non-empty bin is counted with a single binary search.
+        """
+        bins = self.bins
+        for n, run in enumerate(values.runs):
+            offset = n * BINS
+            lo, size = 0, len(run)
+            while lo < size:
+                bin_ = _bin(run[lo])
+                if bin_ == BINS - 1:
+                    hi = size
+                else:
+                    hi = bisect_left(run, (bin_ + 1) * BIN_SECONDS, lo)
+                bins[offset + bin_] += hi - lo
+                lo = hi
+
+    def counts(self, field, i):
+        """
+        Returns bin counts of given field for i-th weekday.
+        """
+        offset = (self.FIELDS.index(field) * 7 + i) * BINS
+        return self.bins[offset:offset + BINS]
+
+
+class Occupancy(object):
+    """
+    Difference array of presence per weekday and SLOT_SECONDS long slot
+    of day.
+
+    Entry adds one at the slot of its start and subtracts one after the
+    slot of its last second, so running sum of changes gives amount of
+    entries overlapping each slot. Changes for given weekday start at
+    weekday * (SLOTS + 1).
+    """
+    __slots__ = ('changes',)
+
+    def __init__(self):
+        self.changes = array(TYPECODE, [0]) * (7 * (SLOTS + 1))
+
+    def add(self, day, start, end, sign=1):
+        """
+        Adds entry to the changes, or subtracts it when sign is -1.
+        """
+        if end <= start:
+            return
+        offset = weekday(day) * (SLOTS + 1)
+        self.changes[offset + start // SLOT_SECONDS] += sign
+        self.changes[offset + (end - 1) // SLOT_SECONDS + 1] -= sign
+
+    def copy(self):
+        """
+        Returns independent copy of changes.
+        """
+        occupancy = Occupancy()
+        occupancy.changes = array(TYPECODE, self.changes)
+        return occupancy
+
+    def update(self, other):
+        """
+        Adds changes of other occupancy to this one.
+        """
+        self.changes = array(TYPECODE, imap(add, self.changes, other.changes))
+
+    def counts(self, i):
+        """
+        Returns amounts of entries overlapping each slot of i-th weekday.
+        """
+        offset = i * (SLOTS + 1)
+        result = []
+        present = 0
+        for change in self.changes[offset:offset + SLOTS]:
+            present += change
+            result.append(present)
+        return result
+
+
+class Rollup(object):
+    """
+    Amounts of entries and total presence in seconds in consecutive time
+    buckets, such as weeks or months. Counts of bucket 'first' are at
+    position 0.
+    """
+    __slots__ = ('first', 'counts', 'totals')
+
+    def __init__(self):
+        self.first = 0
+        self.counts = array(TYPECODE)
+        self.totals = array(TYPECODE)
+
+    def _position(self, bucket):
+        """
+        Returns position of given bucket, growing the arrays to cover it.
+        """
+        if not self.counts:
+            self.first = bucket
+        i = bucket - self.first
+        if i < 0:
+            self.counts[0:0] = array(TYPECODE, [0]) * -i
+            self.totals[0:0] = array(TYPECODE, [0]) * -i
+            self.first = bucket
+            return 0
+        if i >= len(self.counts):
+            grow = i + 1 - len(self.counts)
+            self.counts.extend(array(TYPECODE, [0]) * grow)
+            self.totals.extend(array(TYPECODE, [0]) * grow)
+        return i
+
+    def add(self, bucket, seconds, sign=1):
+        """
+        Adds entry to given bucket, or subtracts it when sign is -1.
+        """
+        i = self._position(bucket)
+        self.counts[i] += sign
+        self.totals[i] += sign * seconds
+
+    def add_totals(self, bucket, count, total):
+        """
+        Adds amount of entries and their total presence to given bucket.
+        """
+        i = self._position(bucket)
+        self.counts[i] += count
+        self.totals[i] += total
+
+    def copy(self):
+        """
+        Returns independent copy of buckets.
+        """
+        rollup = Rollup()
+        rollup.first = self.first
+        rollup.counts = array(TYPECODE, self.counts)
+        rollup.totals = array(TYPECODE, self.totals)
+        return rollup
+
+    def update(self, other):
+        """
+        Adds buckets of other rollup to this one.
+        """
+        if not other.counts:
+            return
+        self._position(other.first)
+        self._position(other.first + len(other.counts) - 1)
+        start = other.first - self.first
+        stop = start + len(other.counts)
+        self.counts[start:stop] = array(
+            TYPECODE, imap(add, self.counts[start:stop], other.counts)
+        )
+        self.totals[start:stop] = array(
+            TYPECODE, imap(add, self.totals[start:stop], other.totals)
+        )
+
+    def items(self, first=None, last=None):
+        """
+        Iterates over (bucket, count, total) tuples of buckets between
+        given ones (inclusive).
+        """
+        lo = 0 if first is None else max(0, first - self.first)
+        hi = len(self.counts)
+        if last is not None:
+            hi = max(lo, min(hi, last - self.first + 1))
+        return izip(
+            xrange(self.first + lo, self.first + hi),
+            self.counts[lo:hi],
+            self.totals[lo:hi],
+        )
+
+
+class UserPresence(object):
+    """
+    Presence entries of a single user.
+
+    Days are kept as date ordinals, starts and ends as seconds since
+    midnight, each in its own typed array sorted by day. For backward
+    compatibility it behaves like the ``{date: {'start': time, 'end': time}}``
+    mapping previously built by ``get_data()``.
+
+    Weekday totals of the entries are kept up to date in WeekdayIndex,
+    their sorted values in WeekdayValues, presence in time slots in
+    Occupancy, and totals per ISO week and per month in Rollups.
+    WeekdayHistogram is counted from the sorted values only when requested,
+    as it is much larger than the entries of most users.
+    """
+    __slots__ = (
+        'days', 'starts', 'ends', 'index', 'values', 'occupancy', 'weeks',
+        'months',
+    )
+
+    def __init__(self):
+        self.days = array(TYPECODE)
+        self.starts = array(TYPECODE)
+        self.ends = array(TYPECODE)
+        self.index = WeekdayIndex()
+        self.values = WeekdayValues()
+        self.occupancy = Occupancy()
+        self.weeks = Rollup()
+        self.months = Rollup()
+
+    def add(self, day, start, end):
+        """
+        Adds entry keeping days sorted. Entry for already known day
+        replaces the old one.
+        """
+        days = self.days
+        self.index.add(day, start, end)
+        self.values.add(day, start, end)
+        self.occupancy.add(day, start, end)
+        self.weeks.add(week(day), end - start)
+        self.months.add(month(day), end - start)
+        if not days or day > days[-1]:
+            days.append(day)
+            self.starts.append(start)
+            self.ends.append(end)
+            return
+
+        pos = bisect_left(days, day)
+        if pos < len(days) and days[pos] == day:
+            self.index.add(day, self.starts[pos], self.ends[pos], sign=-1)
+            self.values.add(day, self.starts[pos], self.ends[pos], sign=-1)
+            self.occupancy.add(
+                day, self.starts[pos], self.ends[pos], sign=-1
+            )
+            interval = self.ends[pos] - self.starts[pos]
+            self.weeks.add(week(day), interval, sign=-1)
+            self.months.add(month(day), interval, sign=-1)
+            self.starts[pos] = start
+            self.ends[pos] = end
+        else:
+            days.insert(pos, day)
+            self.starts.insert(pos, start)
+            self.ends.insert(pos, end)
+
+    def copy(self):
+        """
+        Returns independent copy of entries.
+        """
+        user = UserPresence()
+        user.days = array(TYPECODE, self.days)
+        user.starts = array(TYPECODE, self.starts)
+        user.ends = array(TYPECODE, self.ends)
+        user.index = self.index.copy()
+        user.values = self.values.copy()
+        user.occupancy = self.occupancy.copy()
+        user.weeks = self.weeks.copy()
+        user.months = self.months.copy()
+        return user
+
+    def rows(self, first=None, last=None):
+        """
+        Iterates over (day, start, end) tuples sorted by day, optionally
+        only between given day ordinals (inclusive).
+        """
+        if first is None and last is None:
+            return izip(self.days, self.starts, self.ends)
+        lo, hi = self.span(first, last)
+        return izip(self.days[lo:hi], self.starts[lo:hi], self.ends[lo:hi])
+
+    def span(self, first=None, last=None):
+        """
+        Returns (lo, hi) slice bounds of entries between given day
+        ordinals (inclusive), found by binary search.
+        """
+        lo = 0 if first is None else bisect_left(self.days, first)
+        hi = len(self.days) if last is None else bisect_right(self.days, last)
+        return lo, max(lo, hi)
+
+    def _range_totals(self, totals, first, last):
+        """
+        Returns totals (WeekdayIndex or Occupancy) of entries between given
+        day ordinals, given totals of all entries.
+
+        Totals of the range are either summed from entries in it, or the
+        entries outside of it are subtracted from a copy of given totals,
+        whichever touches fewer entries; cost is linear in their amount.
+        """
+        lo, hi = self.span(first, last)
+        size = len(self.days)
+        if lo == 0 and hi == size:
+            return totals
+        if hi - lo <= size - (hi - lo):
+            result, sign = type(totals)(), 1
+            rows = self.rows(first, last)
+        else:
+            result, sign = totals.copy(), -1
+            rows = chain(
+                izip(self.days[:lo], self.starts[:lo], self.ends[:lo]),
+                izip(self.days[hi:], self.starts[hi:], self.ends[hi:]),
+            )
+        for day, start, end in rows:
+            result.add(day, start, end, sign)
+        return result
+
+    def weekday_index(self, first=None, last=None):
+        """
+        Returns WeekdayIndex of entries between given day ordinals.
+        """
+        return self._range_totals(self.index, first, last)
+
+    def weekday_values(self, first=None, last=None):
+        """
+        Returns WeekdayValues of entries between given day ordinals.
+
+        Values kept up to date are returned when the range covers all
+        entries, otherwise values of entries in the range are sorted.
+        """
+        lo, hi = self.span(first, last)
+        if lo == 0 and hi == len(self.days):
+            return self.values
+        return WeekdayValues.from_rows(self.rows(first, last))
+
+    def weekday_histogram(self, first=None, last=None):
+        """
+        Returns WeekdayHistogram of entries between given day ordinals.
+        """
+        histogram = WeekdayHistogram()
+        histogram.add_values(self.weekday_values(first, last))
+        return histogram
+
+    def weekday_occupancy(self, first=None, last=None):
+        """
+        Returns Occupancy of entries between given day ordinals.
+        """
+        return self._range_totals(self.occupancy, first, last)
+
+    def _find(self, item):
+        """
+        Returns position of given datetime.date or raises KeyError.
+        """
+        try:
+            day = item.toordinal()
+        except AttributeError:
+            raise KeyError(item)
+        pos = bisect_left(self.days, day)
+        if pos == len(self.days) or self.days[pos] != day:
+            raise KeyError(item)
+        return pos
+
+    def __len__(self):
+        return len(self.days)
+
+    def __iter__(self):
+        return (date.fromordinal(day) for day in self.days)
+
+    def __contains__(self, item):
+        try:
+            self._find(item)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, item):
+        pos = self._find(item)
+        return {
+            'start': time_from_seconds(self.starts[pos]),
+            'end': time_from_seconds(self.ends[pos]),
+        }
+
+    def keys(self):
+        """
+        Returns list of dates the user was present.
+        """
+        return list(self)
+
+
+_generations = count(1)
+
+
+def new_generation():
+    """
+    Returns unique, increasing generation number of presence data.
+    """
+    return next(_generations)
+
+
+class PresenceStore(dict):
+    """
+    Presence data of all users: maps user_id to UserPresence.
+
+    Each store gets unique, increasing generation number, which allows to
+    tell whether values computed from presence data are still valid.
+    Loaders set version, which identifies state of the source the same way
+    in all processes, and modification time of the source.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PresenceStore, self).__init__(*args, **kwargs)
+        self.generation = new_generation()
+        self.version = None
+        self.modified = None
+
+    def __setstate__(self, state):
+        # generation of store unpickled from another process could clash
+        # with ones given in this process
+        self.__dict__.update(state)
+        self.generation = new_generation()
+
+    def add(self, user_id, day, start, end):
+        """
+        Adds single presence entry of given user.
+        """
+        try:
+            user = self[user_id]
+        except KeyError:
+            user = self[user_id] = UserPresence()
+        user.add(day, start, end)
+
+    def merged(self, rows):
+        """
+        Returns new store with given (user_id, day, start, end) rows added.
+
+        The store itself is left intact, so it can still be read while the
+        new one is built. Users without new rows are shared between both.
+        """
+        data = PresenceStore(self)
+        copied = set()
+        for user_id, day, start, end in rows:
+            if user_id not in copied:
+                copied.add(user_id)
+                if user_id in data:
+                    data[user_id] = data[user_id].copy()
+            data.add(user_id, day, start, end)
+        return data
+
+    def row_count(self):
+        """
+        Returns total amount of presence entries.
+        """
+        return sum(len(user) for user in self.itervalues())
+
+    def _users(self, user_ids):
+        """
+        Iterates over users with given ids (all by default), skipping
+        unknown ones.
+        """
+        if user_ids is None:
+            return self.itervalues()
+        return (self[user_id] for user_id in user_ids if user_id in self)
+
+    def weekday_index(self, user_ids=None, first=None, last=None):
+        """
+        Returns WeekdayIndex of entries of given users (all by default)
+        between given day ordinals.
+        """
+        index = WeekdayIndex()
+        for user in self._users(user_ids):
+            index.update(user.weekday_index(first, last))
+        return index
+
+    def weekday_histogram(self, user_ids=None, first=None, last=None):
+        """
+        Returns WeekdayHistogram of entries of given users (all by default)
+        between given day ordinals.
+        """
+        histogram = WeekdayHistogram()
+        for user in self._users(user_ids):
+            histogram.add_values(user.weekday_values(first, last))
+        return histogram
+
+    def weekday_occupancy(self, user_ids=None, first=None, last=None):
+        """
+        Returns Occupancy of entries of given users (all by default)
+        between given day ordinals.
+
+        Occupancy of all entries is kept up to date, for date ranges users'
+        rows are scanned, see UserPresence._range_totals.
+        """
+        occupancy = Occupancy()
+        for user in self._users(user_ids):
+            occupancy.update(user.weekday_occupancy(first, last))
+        return occupancy
+
+    def rollup(self, period, user_ids=None):
+        """
+        Returns Rollup of entries of given users (all by default) per
+        'week' or 'month'.
+        """
+        name = 'weeks' if period == 'week' else 'months'
+        rollup = Rollup()
+        for user in self._users(user_ids):
+            rollup.update(getattr(user, name))
+        return rollup
+
+    def sorted_values(self, field, user_ids=None, first=None, last=None):
+        """
+        Returns sorted values of given field ('starts', 'ends' or
+        'intervals') of entries of given users (all by default) between
+        given day ordinals: list of sorted runs for each weekday, one run
+        per user. The runs are not merged, use select() to find values of
+        given rank.
+        """
+        result = [[] for _ in range(7)]
+        for user in self._users(user_ids):
+            values = user.weekday_values(first, last)
+            for i in range(7):
+                run = values.get(field, i)
+                if len(run):
+                    result[i].append(run)
+        return result
+
+    def day_range(self, user_ids=None):
+        """
+        Returns ordinals of the first and the last day with entries of
+        given users (all by default), or (0, -1) if there are none.
+        """
+        users = [user for user in self._users(user_ids) if len(user)]
+        if not users:
+            return 0, -1
+        return (min(user.days[0] for user in users),
+                max(user.days[-1] for user in users))
+
+
+def combine(stores):
+    """
+    Returns PresenceStore with entries of all given stores. Entries of
+    later stores replace entries for the same day from earlier ones.
+
+    Users present in only one of the stores are shared with it.
+    """
+    data = PresenceStore()
+    copied = set()
+    for store in stores:
+        for user_id, user in store.iteritems():
+            if user_id not in data:
+                data[user_id] = user
+                continue
+            if user_id not in copied:
+                copied.add(user_id)
+                data[user_id] = data[user_id].copy()
+            for day, start, end in user.rows():
+                data[user_id].add(day, start, end)
+    return data
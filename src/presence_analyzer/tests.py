@@ -2,12 +2,22 @@
 """
 Presence analyzer unit tests.
 """
+import collections
+import os
 import os.path
 import json
 import datetime
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+from itertools import chain
 
-from presence_analyzer import main, utils
+from presence_analyzer import (
+    main, utils, benchmark, snapshot, store, instrumentation, sqlstore,
+)
 
 
 TEST_DATA_CSV = os.path.join(
@@ -30,6 +40,9 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         Before each test, set up a environment.
         """
         main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'USERS_XML': TEST_USERS_XML})
+        utils.aggregates.clear()
+        utils.responses.clear()
         self.client = main.app.test_client()
 
     def tearDown(self):
@@ -76,6 +89,377 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(len(data), 8)
         self.assertDictEqual(data[0], {u'user_id': 141, u'name': u'Adam P.'})
 
+    def test_api_user(self):
+        """
+        Test user details.
+        """
+        resp = self.client.get('/api/v1/users/141')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), {
+            'user_id': 141,
+            'name': 'Adam P.',
+            'avatar': '/api/images/users/141',
+        })
+        resp = self.client.get('/api/v1/users/1')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_api_mean_time_weekday(self):
+        """
+        Test mean presence time of user grouped by weekday.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(json.loads(resp.data), [
+            ['Mon', 0], ['Tue', 30047], ['Wed', 24465], ['Thu', 23705],
+            ['Fri', 0], ['Sat', 0], ['Sun', 0],
+        ])
+        resp = self.client.get('/api/v1/mean_time_weekday/12')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_api_presence_weekday(self):
+        """
+        Test total presence time of user grouped by weekday.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [
+            ['Weekday', 'Presence (s)'],
+            ['Mon', 0], ['Tue', 30047], ['Wed', 24465], ['Thu', 23705],
+            ['Fri', 0], ['Sat', 0], ['Sun', 0],
+        ])
+
+    def test_api_presence_start_end(self):
+        """
+        Test mean start and end of user presence grouped by weekday.
+        """
+        resp = self.client.get('/api/v1/presence_start_end/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [
+            ['Mon', 0, 0], ['Tue', 34745, 64792], ['Wed', 33592, 58057],
+            ['Thu', 38926, 62631], ['Fri', 0, 0], ['Sat', 0, 0],
+            ['Sun', 0, 0],
+        ])
+
+    def test_api_date_range(self):
+        """
+        Test limiting API results to given dates.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10?from=2013-09-11&to=2013-09-11'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)[1:], [
+            ['Mon', 0], ['Tue', 0], ['Wed', 24465], ['Thu', 0],
+            ['Fri', 0], ['Sat', 0], ['Sun', 0],
+        ])
+        resp = self.client.get('/api/v1/mean_time_weekday/10?from=2013-09-11')
+        self.assertEqual(json.loads(resp.data)[1:4], [
+            ['Tue', 0], ['Wed', 24465], ['Thu', 23705],
+        ])
+        resp = self.client.get('/api/v1/presence_start_end/10?to=2013-09-10')
+        self.assertEqual(json.loads(resp.data)[1:3], [
+            ['Tue', 34745, 64792], ['Wed', 0, 0],
+        ])
+        resp = self.client.get('/api/v1/presence_start_end/10?to=2013-9-1')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_batch(self):
+        """
+        Test returning several metrics of several users at once.
+        """
+        resp = self.client.get(
+            '/api/v1/batch?user_id=10,12&user_id=11'
+            '&metric=presence_weekday,mean_time_weekday'
+        )
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), ['10', '11', '12'])
+        self.assertItemsEqual(
+            data['10'].keys(), ['presence_weekday', 'mean_time_weekday']
+        )
+        self.assertEqual(
+            data['10']['presence_weekday'],
+            json.loads(self.client.get('/api/v1/presence_weekday/10').data)
+        )
+        self.assertEqual(data['12'], {
+            'presence_weekday': [], 'mean_time_weekday': [],
+        })
+
+        resp = self.client.get('/api/v1/batch?user_id=11')
+        self.assertItemsEqual(
+            json.loads(resp.data)['11'].keys(), utils.METRICS.keys()
+        )
+        resp = self.client.get('/api/v1/batch?user_id=11&metric=foo')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/batch?user_id=bar')
+        self.assertEqual(resp.status_code, 400)
+        for user_id in (11, 999):
+            resp = self.client.get(
+                '/api/v1/batch?user_id=%d&from=garbage' % user_id
+            )
+            self.assertEqual(resp.status_code, 400)
+
+    def test_api_aggregate(self):
+        """
+        Test aggregating presence of many users by weekday.
+        """
+        resp = self.client.get('/api/v1/aggregate/sum')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)[1], ['Tue', 30047 + 16564])
+        resp = self.client.get('/api/v1/aggregate/mean?user_id=10,11')
+        self.assertEqual(
+            json.loads(resp.data)[1], ['Tue', (30047 + 16564) / 2.0]
+        )
+        resp = self.client.get(
+            '/api/v1/aggregate/percentile?field=start&q=0&q=100&user_id=11'
+        )
+        self.assertEqual(json.loads(resp.data)[:2], [
+            ['Mon', 33134, 33134], ['Tue', 33590, 33590],
+        ])
+        resp = self.client.get('/api/v1/aggregate/median')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/aggregate/percentile?q=101')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_distribution(self):
+        """
+        Test percentiles and histograms of presence by weekday.
+        """
+        resp = self.client.get('/api/v1/distribution/10')
+        self.assertEqual(resp.status_code, 200)
+        tuesday = json.loads(resp.data)[1]
+        self.assertEqual(tuesday['weekday'], 'Tue')
+        self.assertEqual(tuesday['start'], {
+            'count': 1,
+            'percentiles': [[50, 34745], [90, 34745]],
+            'histogram': [[34200, 1]],
+        })
+        self.assertEqual(tuesday['interval']['percentiles'][0], [50, 30047])
+        self.assertEqual(json.loads(resp.data)[0]['end']['count'], 0)
+
+        resp = self.client.get('/api/v1/distribution?field=start&q=50')
+        tuesday = json.loads(resp.data)[1]
+        self.assertEqual(tuesday['start']['percentiles'], [[50, 34167.5]])
+        resp = self.client.get('/api/v1/aggregate/percentile?field=start')
+        self.assertEqual(json.loads(resp.data)[1][1], 34167.5)
+        self.assertEqual(tuesday['start']['histogram'],
+                         [[33000, 1], [34200, 1]])
+        resp = self.client.get('/api/v1/distribution?user_id=11&q=50')
+        self.assertEqual(
+            json.loads(resp.data)[1]['start']['histogram'], [[33000, 1]]
+        )
+
+        resp = self.client.get('/api/v1/distribution/1')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.client.get('/api/v1/distribution?q=101')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_timeseries(self):
+        """
+        Test presence totals per week and month.
+        """
+        resp = self.client.get('/api/v1/timeseries/week/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [
+            ['2013-W37', 3, 30047 + 24465 + 23705],
+        ])
+        resp = self.client.get('/api/v1/timeseries/month/10')
+        self.assertEqual(json.loads(resp.data), [
+            ['2013-09', 3, 30047 + 24465 + 23705],
+        ])
+
+        resp = self.client.get('/api/v1/timeseries/week')
+        weeks = json.loads(resp.data)
+        self.assertEqual(weeks[0], ['2013-W36', 1, 22999])
+        self.assertEqual(weeks[1][:2], ['2013-W37', 8])
+        resp = self.client.get('/api/v1/timeseries/week?from=2013-09-09')
+        self.assertEqual(json.loads(resp.data), weeks[1:])
+        resp = self.client.get(
+            '/api/v1/timeseries/week?user_id=10&to=2013-09-08'
+        )
+        self.assertEqual(json.loads(resp.data), [])
+
+        resp = self.client.get('/api/v1/timeseries/week/1')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.client.get('/api/v1/timeseries/year')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/timeseries/week?from=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_occupancy(self):
+        """
+        Test mean amount of people present per weekday and time slot.
+        """
+        resp = self.client.get('/api/v1/occupancy')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['slots']), 96)
+        self.assertEqual(data['slots'][38], '09:30')
+        self.assertEqual(data['weekdays'][1], 'Tue')
+        self.assertEqual(data['days'], [1, 1, 1, 2, 2, 1, 1])
+        tuesday = data['occupancy'][1]
+        self.assertEqual(tuesday[36:39], [0, 1, 2])
+        self.assertEqual(tuesday[55:57], [2, 1])
+        self.assertEqual(tuesday[71:73], [1, 0])
+        self.assertEqual(data['occupancy'][3][38], 0.5)
+
+        resp = self.client.get(
+            '/api/v1/occupancy?user_id=10&from=2013-09-09&to=2013-09-22'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(data['days'], [2] * 7)
+        self.assertEqual(data['occupancy'][1][38], 0.5)
+        resp = self.client.get('/api/v1/occupancy?user_id=x')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_conditional_get(self):
+        """
+        Test answering conditional requests with 304 Not Modified.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        etag = resp.headers['ETag']
+        self.assertIn('Last-Modified', resp.headers)
+        self.assertIn('max-age=0', resp.headers['Cache-Control'])
+        resp = self.client.get('/api/v1/presence_weekday/11')
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get('/api/v1/presence_weekday/10',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+        resp = self.client.get('/api/v1/presence_weekday/10',
+                               headers={'If-None-Match': '"other"'})
+        self.assertEqual(resp.status_code, 200)
+
+        last_modified = self.client.get('/api/v1/users').headers[
+            'Last-Modified'
+        ]
+        resp = self.client.get('/api/v1/users',
+                               headers={'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get(
+            '/api/v1/users',
+            headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'}
+        )
+        self.assertEqual(resp.status_code, 200)
+
+    def test_api_cached_response(self):
+        """
+        Test reusing serialized and compressed responses.
+        """
+        main.app.config.update({'GZIP_MIN_SIZE': 0})
+        try:
+            url = '/api/v1/mean_time_weekday/11'
+            resp = self.client.get(url)
+            self.assertIsNone(resp.content_encoding)
+            self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+            hits = utils.responses.info()['hits']
+            gzipped = self.client.get(
+                url, headers={'Accept-Encoding': 'gzip, deflate'}
+            )
+            self.assertEqual(utils.responses.info()['hits'], hits + 1)
+            self.assertEqual(gzipped.content_encoding, 'gzip')
+            self.assertEqual(
+                zlib.decompress(gzipped.data, 16 + zlib.MAX_WBITS), resp.data
+            )
+            etag = resp.headers['ETag']
+            self.assertNotEqual(gzipped.headers['ETag'], etag)
+            resp = self.client.get(url, headers={
+                'Accept-Encoding': 'gzip',
+                'If-None-Match': gzipped.headers['ETag'],
+            })
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], gzipped.headers['ETag'])
+            self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+            resp = self.client.get(url, headers={
+                'Accept-Encoding': 'gzip',
+                'If-Modified-Since': gzipped.headers['Last-Modified'],
+            })
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], gzipped.headers['ETag'])
+            # without cached body the view is not called for 304
+            utils.responses.clear()
+            resp = self.client.get(url, headers={
+                'Accept-Encoding': 'gzip',
+                'If-Modified-Since': gzipped.headers['Last-Modified'],
+            })
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+            self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(utils.responses.info()['size'], 0)
+            resp = self.client.get(url, headers={
+                'If-None-Match': gzipped.headers['ETag'],
+            })
+            self.assertEqual(resp.status_code, 200)
+            self.assertIsNone(resp.content_encoding)
+        finally:
+            del main.app.config['GZIP_MIN_SIZE']
+
+    def test_api_export(self):
+        """
+        Test exporting weekday aggregates of all users.
+        """
+        resp = self.client.get('/api/v1/export')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 1 + 2 * 7)
+        self.assertEqual(
+            lines[0], 'user_id,weekday,days,presence,mean_presence,'
+            'mean_start,mean_end'
+        )
+        self.assertEqual(lines[2], '10,Tue,1,30047,30047.0,34745.0,64792.0')
+        self.assertEqual(lines[8], '11,Mon,1,24123,24123.0,33134.0,57257.0')
+
+        resp = self.client.get('/api/v1/export?format=ndjson&user_id=11')
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[0]['user_id'], 11)
+        self.assertEqual(rows[0]['presence'], 24123)
+
+        size = utils.aggregates.info()['size']
+        resp = self.client.get('/api/v1/export?from=2013-09-10')
+        self.assertEqual(len(resp.data.splitlines()), 1 + 2 * 7)
+        self.assertEqual(utils.aggregates.info()['size'], size)
+
+        resp = self.client.get('/api/v1/export?format=xml')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_warmup(self):
+        """
+        Test holding requests until data is loaded at startup.
+        """
+        warmup = utils.warmup
+        utils.warmup = utils.Warmup()
+        main.app.config.update({'WARMUP_TIMEOUT': 0})
+        try:
+            resp = self.client.get('/api/v1/ready')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.data)['state'], 'idle')
+
+            utils.warmup.state = 'loading'
+            resp = self.client.get('/api/v1/presence_weekday/10')
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+            resp = self.client.get('/api/v1/ready')
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(json.loads(resp.data)['progress'], 0)
+
+            utils.warmup.start()
+            self.assertTrue(utils.warmup.wait(5))
+            resp = self.client.get('/api/v1/ready')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.data)['state'], 'ready')
+            self.assertEqual(json.loads(resp.data)['progress'], 1)
+            resp = self.client.get('/api/v1/presence_weekday/10')
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            utils.warmup = warmup
+            del main.app.config['WARMUP_TIMEOUT']
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -88,6 +472,8 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         """
         main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
         main.app.config.update({'USERS_XML': TEST_USERS_XML})
+        utils.aggregates.clear()
+        utils.responses.clear()
 
     def tearDown(self):
         """
@@ -108,6 +494,109 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(data[10][sample_date]['start'],
                          datetime.time(9, 39, 5))
 
+    def test_cache(self):
+        """
+        Test serving cached and stale values while refreshing them
+        """
+        calls = []
+
+        @utils.cache(0.05)
+        def function(value):
+            calls.append(value)
+            return len(calls)
+
+        self.assertEqual(function(1), 1)
+        self.assertEqual(function(1), 1)
+        self.assertEqual(function(2), 2)
+        info = function.cache_info()
+        self.assertEqual((info['misses'], info['hits']), (2, 1))
+
+        time.sleep(0.06)
+        self.assertEqual(function(1), 1)
+        for _ in range(100):
+            if function.cache_info()['refreshes']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(function(1), 3)
+        info = function.cache_info()
+        self.assertEqual((info['stale'], info['refreshes']), (1, 1))
+
+        function.cache_clear()
+        self.assertEqual(function(1), 4)
+
+    def test_aggregate_cache(self):
+        """
+        Test evicting least recently used and outdated aggregates
+        """
+        aggregates = utils.AggregateCache(maxsize=2, ttl=600)
+        self.assertEqual(aggregates.get(1, 'a', lambda: 'A'), 'A')
+        self.assertEqual(aggregates.get(1, 'b', lambda: 'B'), 'B')
+        self.assertEqual(aggregates.get(1, 'a', lambda: 'X'), 'A')
+        self.assertEqual(aggregates.get(1, 'c', lambda: 'C'), 'C')
+        self.assertEqual(aggregates.get(1, 'b', lambda: 'X'), 'X')
+        self.assertEqual(aggregates.get(2, 'a', lambda: 'Y'), 'Y')
+        info = aggregates.info()
+        self.assertEqual((info['hits'], info['misses']), (1, 5))
+        self.assertEqual(info['hit_ratio'], 1 / 6.0)
+        self.assertEqual(info['size'], 1)
+
+        # values of older generation neither reset cache nor are stored
+        self.assertEqual(aggregates.get(1, 'a', lambda: 'O'), 'O')
+        self.assertEqual(aggregates.get(1, 'a', lambda: 'P'), 'P')
+        self.assertEqual(aggregates.get(2, 'a', lambda: 'X'), 'Y')
+
+        aggregates.configure(maxsize=2, ttl=-1)
+        self.assertEqual(aggregates.get(2, 'a', lambda: 'Z'), 'Z')
+
+    def test_user_aggregate(self):
+        """
+        Test caching aggregates of single user per data generation
+        """
+        data = utils.get_data()
+        # range leaving out the first entry, so kept totals are not used
+        first = data[10].days[1]
+        self.assertIs(
+            utils.weekday_index(data, 10, first),
+            utils.weekday_index(data, 10, first),
+        )
+        new_data = data.merged([])
+        self.assertNotEqual(new_data.generation, data.generation)
+        self.assertIsNot(
+            utils.weekday_index(new_data, 10, first),
+            utils.weekday_index(data, 10, first),
+        )
+
+    def test_percentile(self):
+        """
+        Test calculating percentiles of sorted values
+        """
+        self.assertEqual(utils.percentile([], 50), 0)
+        self.assertEqual(utils.percentile([5], 90), 5)
+        self.assertEqual(utils.percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertEqual(utils.percentile([1, 2, 3, 4], 0), 1)
+        self.assertEqual(utils.percentile([1, 2, 3, 4], 100), 4)
+        self.assertEqual(utils.runs_percentile([], 50), 0)
+        self.assertEqual(utils.runs_percentile([[1, 4], [2, 3]], 50), 2.5)
+        self.assertAlmostEqual(
+            utils.runs_percentile([[4], [1, 2, 3]], 90), 3.7
+        )
+
+    def test_group_percentile(self):
+        """
+        Test group percentiles equal ones of merged values of all users
+        """
+        data = utils.get_data()
+        result = utils.group_aggregate(data, 'percentile', 'start',
+                                       data.keys(), quantiles=(50, 90))
+        for weekday, row in enumerate(result):
+            values = sorted(
+                start for user in data.itervalues()
+                for day, start, end in user.rows()
+                if store.weekday(day) == weekday
+            )
+            self.assertEqual(row[1:], [utils.percentile(values, 50),
+                                       utils.percentile(values, 90)])
+
     def test_mean(self):
         """
         Test calculating arithmetic mean
@@ -189,6 +678,46 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(len(sample_data), 7)
         self.assertEqual(sample_data, expected_result)
 
+    def test_parse_time(self):
+        """
+        Test parsing HH:MM:SS into seconds since midnight
+        """
+        self.assertEqual(utils.parse_time('02:30:15'), 9015)
+        self.assertEqual(utils.parse_time('00:00:00'), 0)
+        invalid = ('2:30:15', '02-30-15', '24:00:00', '12:60:00', 'ab:cd:ef')
+        for value in invalid:
+            with self.assertRaises(ValueError):
+                utils.parse_time(value)
+
+    def test_parse_date(self):
+        """
+        Test parsing YYYY-MM-DD into day ordinal
+        """
+        self.assertEqual(
+            utils.parse_date('2013-09-10'),
+            datetime.date(2013, 9, 10).toordinal()
+        )
+        for value in ('2013-9-10', '2013/09/10', '2013-02-30'):
+            with self.assertRaises(ValueError):
+                utils.parse_date(value)
+
+    def test_parse_presence_lines(self):
+        """
+        Test skipping header, footer and malformed lines
+        """
+        lines = [
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\r\n',
+            '10,2013-09-11,9:19:52,16:07:37\n',
+            'x,2013-09-12,10:48:46,17:23:51\n',
+            '11,2013-09-05,09:28:08,15:51:27',
+            'footer\n',
+        ]
+        self.assertEqual(list(utils.parse_presence_lines(lines)), [
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792),
+            (11, datetime.date(2013, 9, 5).toordinal(), 34088, 57087),
+        ])
+
     def test_parse_users_xml(self):
         """
         Test xml parser
@@ -200,6 +729,1030 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(parsed_data[5], expected_result)
 
 
+class PresenceAnalyzerLoaderTestCase(unittest.TestCase):
+    """
+    Incremental CSV loader tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, copy test data to temporary file.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+
+    def tearDown(self):
+        """
+        Remove temporary files.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, content, mode='a'):
+        """
+        Writes content to the temporary data file.
+        """
+        with open(self.path, mode) as csvfile:
+            csvfile.write(content)
+
+    def test_load_appended_lines(self):
+        """
+        Test parsing only lines appended since previous load
+        """
+        loader = utils.PresenceLoader(self.path)
+        data = loader.load()
+        self.assertIs(loader.load(), data)
+        self.assertEqual(len(data[11]), 6)
+
+        self.write('\n12,2013-09-13,08:00:00,16:00:00\n')
+        new_data = loader.load()
+        self.assertIsNot(new_data, data)
+        self.assertIs(new_data[10], data[10])
+        self.assertEqual(len(new_data[11]), 6)
+        self.assertEqual(len(new_data[12]), 1)
+        self.assertNotIn(12, data)
+
+        self.write('12,2013-09-16,08:00:00,16:00:00\n')
+        self.assertEqual(len(loader.load()[12]), 2)
+        self.assertEqual(
+            [count for _, count, _ in loader.load()[12].weeks.items()],
+            [1, 1]
+        )
+        self.assertEqual(loader.load().row_count(), 11)
+
+    def test_load_partial_line(self):
+        """
+        Test completing line which was partially written during load
+        """
+        loader = utils.PresenceLoader(self.path)
+        loader.load()
+        self.write('\n12,2013-09-13,08:00')
+        self.assertNotIn(12, loader.load())
+        self.write(':00,16:00:00\n')
+        self.assertEqual(len(loader.load()[12]), 1)
+
+    def test_load_stats(self):
+        """
+        Test counting rows and rejected lines
+        """
+        loader = utils.PresenceLoader(self.path)
+        loader.load()
+        self.write('\n12,2013-09-13,8:00:00,16:00:00\n12,2013-09-1')
+        loader.load()
+        stats = loader.stats()
+        self.assertEqual(stats['loads'], 2)
+        self.assertEqual(stats['rows'], 9)
+        self.assertEqual(stats['users'], 2)
+        self.assertEqual(stats['rejected'], 1)
+
+        self.write('6,08:00:00,16:00:00\n')
+        loader.load()
+        self.assertEqual(loader.stats()['rejected'], 1)
+        self.assertEqual(loader.stats()['rows'], 10)
+
+        self.write('12,2013-09-13,08:00:00,16:00:00\n', mode='w')
+        loader.load()
+        self.assertEqual(loader.stats()['rejected'], 0)
+
+    def test_load_truncated_file(self):
+        """
+        Test rebuilding data when file was truncated or rewritten
+        """
+        loader = utils.PresenceLoader(self.path)
+        loader.load()
+        self.write('12,2013-09-13,08:00:00,16:00:00\n', mode='w')
+        data = loader.load()
+        self.assertItemsEqual(data.keys(), [12])
+
+        self.write('13,2013-09-13,08:00:00,16:00:00\n'
+                   '13,2013-09-16,08:00:00,16:00:00\n', mode='w')
+        data = loader.load()
+        self.assertItemsEqual(data.keys(), [13])
+        self.assertEqual(len(data[13]), 2)
+
+
+class PresenceAnalyzerMultiFileLoaderTestCase(unittest.TestCase):
+    """
+    Loading presence data split into many files tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, write monthly files to temporary directory.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.write('2013-08.csv', '10,2013-08-30,09:00:00,17:00:00\n'
+                                  '11,2013-08-30,10:00:00,18:00:00\n')
+        self.write('2013-09.csv', '10,2013-09-02,08:00:00,16:00:00\n')
+        self.write('notes.txt', 'not presence data\n')
+
+    def tearDown(self):
+        """
+        Remove temporary files.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content, mode='w'):
+        """
+        Writes content to file in temporary directory.
+        """
+        with open(os.path.join(self.tmpdir, name), mode) as csvfile:
+            csvfile.write(content)
+
+    def test_data_files(self):
+        """
+        Test finding data files in directory or by glob pattern
+        """
+        expected = [
+            os.path.join(self.tmpdir, '2013-08.csv'),
+            os.path.join(self.tmpdir, '2013-09.csv'),
+        ]
+        self.assertEqual(utils.data_files(self.tmpdir), expected)
+        self.assertEqual(
+            utils.data_files(os.path.join(self.tmpdir, '2013-0[89].csv')),
+            expected
+        )
+
+    def test_load(self):
+        """
+        Test merging files parsed in parallel and reloading changed ones
+        """
+        loader = utils.MultiFileLoader(self.tmpdir, processes=2)
+        data = loader.load()
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(len(data[10]), 2)
+        self.assertEqual(data[10].index.counts[0], 1)
+        self.assertIs(loader.load(), data)
+
+        august = loader.loaders[os.path.join(self.tmpdir, '2013-08.csv')]
+        august_data = august.data
+        self.write('2013-09.csv', '12,2013-09-02,08:00:00,16:00:00\n', 'a')
+        new_data = loader.load()
+        self.assertIsNot(new_data, data)
+        self.assertIs(august.data, august_data)
+        self.assertIs(new_data[11], august_data[11])
+        self.assertEqual(new_data.row_count(), 4)
+        self.assertNotEqual(new_data.version, data.version)
+
+        self.write('2013-10.csv', '10,2013-09-02,07:00:00,15:00:00\n')
+        new_data = loader.load()
+        self.assertEqual(len(new_data[10]), 2)
+        self.assertEqual(new_data[10].starts[-1], 7 * 3600)
+
+    def test_load_in_threaded_process(self):
+        """
+        Test parsing files in-process while other threads are running
+        """
+        def pool(processes):
+            raise AssertionError('Pool forked with running threads')
+
+        stopped = threading.Event()
+        thread = threading.Thread(target=stopped.wait)
+        thread.start()
+        original, utils.Pool = utils.Pool, pool
+        try:
+            loader = utils.MultiFileLoader(self.tmpdir, processes=2)
+            self.assertEqual(loader.load().row_count(), 3)
+        finally:
+            utils.Pool = original
+            stopped.set()
+            thread.join()
+
+    def test_data_service(self):
+        """
+        Test writing snapshot of all files in directory
+        """
+        service = utils.DataService(self.tmpdir, TEST_USERS_XML)
+        self.assertTrue(service.update())
+        self.assertEqual(service.path, self.tmpdir + '.snapshot')
+        try:
+            data = utils.SnapshotLoader(self.tmpdir).load()
+            expected = utils.MultiFileLoader(self.tmpdir).load()
+            self.assertEqual(data.row_count(), 3)
+            self.assertEqual(list(data[10].rows()),
+                             list(expected[10].rows()))
+            self.assertEqual(data.version, expected.version)
+        finally:
+            os.remove(service.path)
+
+
+class PresenceAnalyzerSnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, copy test data to temporary directory.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'data.csv')
+        self.xml_path = os.path.join(self.tmpdir, 'users.xml')
+        shutil.copy(TEST_DATA_CSV, self.csv_path)
+        shutil.copy(TEST_USERS_XML, self.xml_path)
+        main.app.config.update({
+            'DATA_CSV': self.csv_path,
+            'USERS_XML': self.xml_path,
+        })
+
+    def tearDown(self):
+        """
+        Remove temporary files and restore configuration.
+        """
+        shutil.rmtree(self.tmpdir)
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'USERS_XML': TEST_USERS_XML,
+        })
+
+    def test_write_and_read(self):
+        """
+        Test restoring presence data and users from snapshot
+        """
+        path = utils.write_snapshot()
+        self.assertEqual(path, snapshot.snapshot_path(self.csv_path))
+        expected = utils.load_presence_csv(self.csv_path)
+        data, meta = snapshot.read(path)
+        self.assertItemsEqual(data.keys(), expected.keys())
+        for user_id in expected:
+            user = data[user_id]
+            self.assertIsInstance(user.days, snapshot.MappedColumn)
+            for name in ('days', 'starts', 'ends'):
+                self.assertEqual(
+                    list(getattr(user, name)),
+                    list(getattr(expected[user_id], name))
+                )
+            self.assertEqual(
+                list(user.index.intervals),
+                list(expected[user_id].index.intervals)
+            )
+            self.assertEqual(
+                list(user.occupancy.changes),
+                list(expected[user_id].occupancy.changes)
+            )
+            self.assertEqual(
+                [list(run) for run in user.values.runs],
+                [list(run) for run in expected[user_id].values.runs]
+            )
+            for name in ('weeks', 'months'):
+                rollup = getattr(user, name)
+                other = getattr(expected[user_id], name)
+                self.assertEqual(list(rollup.items()), list(other.items()))
+        self.assertIn(datetime.date(2013, 9, 10), data[10])
+        self.assertEqual(data[10].days[-1], expected[10].days[-1])
+        self.assertEqual(data[11].days[1:3], expected[11].days[1:3])
+        self.assertEqual(
+            list(data[11].rows(*expected[11].days[2:4])),
+            list(expected[11].rows(*expected[11].days[2:4]))
+        )
+        self.assertEqual(len(meta['users']), 8)
+
+    def test_loader_restore(self):
+        """
+        Test parsing only lines appended after snapshot was written
+        """
+        utils.write_snapshot()
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-13,08:00:00,16:00:00\n')
+        loader = utils.PresenceLoader(self.csv_path)
+        data = loader.load()
+        self.assertIsInstance(data[10].days, snapshot.MappedColumn)
+        self.assertEqual(len(data[12]), 1)
+        self.assertEqual(data.row_count(), 10)
+
+    def test_get_users(self):
+        """
+        Test parsing users file again only when it changes
+        """
+        users = utils.get_users()
+        self.assertIs(utils.get_users(), users)
+        self.assertEqual(users.by_id[19]['avatar'], '/api/images/users/19')
+        self.assertEqual(json.loads(users.json), users.listing)
+        with open(self.xml_path, 'w') as xmlfile:
+            xmlfile.write(
+                '<intranet><users><user id="1"><name>A B.</name></user>'
+                '</users></intranet>'
+            )
+        users = utils.get_users()
+        self.assertEqual(users.listing, [{'user_id': 1, 'name': 'A B.'}])
+        self.assertIsNone(users.by_id[1]['avatar'])
+
+    def test_snapshot_users(self):
+        """
+        Test reading users from snapshot until users file changes
+        """
+        utils.write_snapshot()
+        users = utils.snapshot_users(self.csv_path, self.xml_path)
+        self.assertEqual(users, utils.read_users_xml(self.xml_path))
+        with open(self.xml_path, 'a') as xmlfile:
+            xmlfile.write('\n')
+        self.assertIsNone(utils.snapshot_users(self.csv_path, self.xml_path))
+
+    def test_data_service(self):
+        """
+        Test writing snapshot only when data or users change
+        """
+        service = utils.DataService(self.csv_path, self.xml_path)
+        self.assertTrue(service.update())
+        self.assertFalse(service.update())
+        loader = utils.SnapshotLoader(self.csv_path)
+        data = loader.load()
+        self.assertIsInstance(data[10].days, snapshot.MappedColumn)
+        self.assertIs(loader.load(), data)
+        self.assertEqual(
+            data.version,
+            utils.PresenceLoader(self.csv_path, use_snapshot=False).load()
+            .version
+        )
+
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-13,08:00:00,16:00:00\nfoo,bar,,\n')
+        self.assertTrue(service.update())
+        new_data = loader.load()
+        self.assertIsNot(new_data, data)
+        self.assertEqual(len(new_data[12]), 1)
+        self.assertEqual(loader.stats()['rejected'], 1)
+        self.assertEqual(loader.stats()['rows'], 10)
+        self.assertNotIn(12, data)
+
+        with open(self.xml_path, 'a') as xmlfile:
+            xmlfile.write('\n')
+        self.assertTrue(service.update())
+        self.assertEqual(service.writes, 3)
+        self.assertEqual(
+            utils.snapshot_users(self.csv_path, self.xml_path),
+            utils.read_users_xml(self.xml_path),
+        )
+
+    def test_snapshot_storage(self):
+        """
+        Test API views reading data mapped from snapshot
+        """
+        client = main.app.test_client()
+        urls = [
+            '/api/v1/presence_weekday/10',
+            '/api/v1/aggregate/percentile?user_id=10,11&q=25',
+            '/api/v1/occupancy',
+        ]
+        utils.get_data.cache_clear()
+        try:
+            expected = [client.get(url) for url in urls]
+            utils.write_snapshot()
+            main.app.config.update({'STORAGE': 'snapshot'})
+            utils.get_data.cache_clear()
+            self.assertIsInstance(
+                utils.get_data()[10].days, snapshot.MappedColumn
+            )
+            for url, other in zip(urls, expected):
+                resp = client.get(url)
+                self.assertEqual(resp.data, other.data)
+                self.assertEqual(resp.headers['ETag'], other.headers['ETag'])
+        finally:
+            main.app.config.update({'STORAGE': 'csv'})
+            utils.get_data.cache_clear()
+
+    def test_snapshot_users_storage(self):
+        """
+        Test reading users only from snapshot with snapshot storage
+        """
+        client = main.app.test_client()
+        expected = client.get('/api/v1/users')
+        path = utils.write_snapshot()
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+        with open(self.xml_path, 'w') as xmlfile:
+            xmlfile.write('<intranet><users></users></intranet>')
+        main.app.config.update({'STORAGE': 'snapshot'})
+        try:
+            resp = client.get('/api/v1/users')
+            self.assertEqual(resp.data, expected.data)
+            self.assertEqual(resp.headers['ETag'], expected.headers['ETag'])
+        finally:
+            main.app.config.update({'STORAGE': 'csv'})
+        self.assertEqual(utils.get_users().listing, [])
+
+    def test_missing_snapshot(self):
+        """
+        Test answering 503 until snapshot is written
+        """
+        client = main.app.test_client()
+        warmup = utils.warmup
+        utils.warmup = utils.Warmup()
+        utils.warmup.retry_seconds = 0.01
+        main.app.config.update({'STORAGE': 'snapshot', 'WARMUP_TIMEOUT': 0})
+        utils.get_data.cache_clear()
+        try:
+            resp = client.get('/api/v1/presence_weekday/10')
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+            resp = client.get('/api/v1/users')
+            self.assertEqual(resp.status_code, 503)
+
+            utils.warmup.start()
+            time.sleep(0.05)
+            resp = client.get('/api/v1/ready')
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(json.loads(resp.data)['state'], 'loading')
+            self.assertIsNotNone(json.loads(resp.data)['error'])
+
+            utils.write_snapshot()
+            self.assertTrue(utils.warmup.wait(5))
+            self.assertEqual(utils.warmup.state, 'ready')
+            resp = client.get('/api/v1/presence_weekday/10')
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            utils.warmup = warmup
+            main.app.config.update({'STORAGE': 'csv'})
+            del main.app.config['WARMUP_TIMEOUT']
+            utils.get_data.cache_clear()
+
+    def test_invalid_snapshot(self):
+        """
+        Test ignoring corrupted snapshot
+        """
+        with open(snapshot.snapshot_path(self.csv_path), 'w') as f:
+            f.write('garbage')
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.read(snapshot.snapshot_path(self.csv_path))
+        loader = utils.PresenceLoader(self.csv_path)
+        self.assertEqual(loader.load().row_count(), 9)
+
+
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    Presence store tests.
+    """
+
+    def test_user_presence_add(self):
+        """
+        Test keeping entries sorted by day and replacing duplicates
+        """
+        user = store.UserPresence()
+        user.add(735000, 100, 200)
+        user.add(734990, 300, 400)
+        user.add(735010, 500, 600)
+        user.add(735000, 700, 800)
+        self.assertEqual(list(user.days), [734990, 735000, 735010])
+        self.assertEqual(list(user.starts), [300, 700, 500])
+        self.assertEqual(list(user.ends), [400, 800, 600])
+
+    def test_user_presence_span(self):
+        """
+        Test finding entries between given days
+        """
+        user = store.UserPresence()
+        for day in (10, 12, 14, 16):
+            user.add(day, day, day + 1)
+        self.assertEqual(user.span(), (0, 4))
+        self.assertEqual(user.span(12, 14), (1, 3))
+        self.assertEqual(user.span(11, 15), (1, 3))
+        self.assertEqual(user.span(17, None), (4, 4))
+        self.assertEqual(user.span(15, 11), (3, 3))
+        self.assertEqual(
+            list(user.rows(None, 12)), [(10, 10, 11), (12, 12, 13)]
+        )
+        self.assertEqual(user.weekday_index(13, 20).counts[(16 - 1) % 7], 1)
+        self.assertEqual(sum(user.weekday_index(13, 20).counts), 2)
+
+    def test_weekday_index(self):
+        """
+        Test keeping weekday totals up to date
+        """
+        user = store.UserPresence()
+        tuesday = datetime.date(2013, 9, 10).toordinal()
+        user.add(tuesday, 100, 400)
+        user.add(tuesday + 7, 200, 300)
+        user.add(tuesday + 1, 1000, 1500)
+        user.add(tuesday + 7, 300, 900)
+        index = user.index
+        self.assertEqual(list(index.counts), [0, 2, 1, 0, 0, 0, 0])
+        self.assertEqual(list(index.intervals), [0, 900, 500, 0, 0, 0, 0])
+        self.assertEqual(list(index.starts), [0, 400, 1000, 0, 0, 0, 0])
+        self.assertEqual(list(index.ends), [0, 1300, 1500, 0, 0, 0, 0])
+        self.assertEqual(index.mean(index.intervals, 1), 450)
+        self.assertEqual(index.mean(index.intervals, 0), 0)
+
+        copy = user.copy()
+        copy.add(tuesday + 14, 0, 100)
+        self.assertEqual(copy.index.counts[1], 3)
+        self.assertEqual(index.counts[1], 2)
+
+    def test_weekday_values(self):
+        """
+        Test keeping sorted weekday values up to date
+        """
+        user = store.UserPresence()
+        tuesday = datetime.date(2013, 9, 10).toordinal()
+        user.add(tuesday, 300, 400)
+        user.add(tuesday + 7, 100, 600)
+        user.add(tuesday + 14, 200, 900)
+        user.add(tuesday + 7, 500, 600)
+        values = user.values
+        self.assertEqual(list(values.get('starts', 1)), [200, 300, 500])
+        self.assertEqual(list(values.get('ends', 1)), [400, 600, 900])
+        self.assertEqual(list(values.get('intervals', 1)), [100, 100, 700])
+        self.assertEqual(len(values.get('starts', 0)), 0)
+        self.assertIs(user.weekday_values(tuesday, None), values)
+        self.assertEqual(
+            list(user.weekday_values(tuesday + 7).get('starts', 1)),
+            [200, 500]
+        )
+
+        copy = user.copy()
+        copy.add(tuesday + 21, 0, 100)
+        self.assertEqual(
+            list(copy.values.get('starts', 1)), [0, 200, 300, 500]
+        )
+        self.assertEqual(len(values.get('starts', 1)), 3)
+
+    def test_select(self):
+        """
+        Test finding values of given rank in several sorted runs
+        """
+        runs = [[1, 5, 9], [], [2, 5, 6, 10]]
+        merged = sorted(sum(runs, []))
+        for k in range(len(merged)):
+            self.assertEqual(store.select(runs, k), merged[k])
+        self.assertEqual(store.select([[-3, 4]], 1), 4)
+
+    def test_weekday_histogram(self):
+        """
+        Test building weekday histograms of entries
+        """
+        user = store.UserPresence()
+        tuesday = datetime.date(2013, 9, 10).toordinal()
+        user.add(tuesday, 9 * 3600, 17 * 3600)
+        user.add(tuesday + 7, 8 * 3600, 16 * 3600)
+        user.add(tuesday + 14, 10 * 3600, 12 * 3600)
+        user.add(tuesday + 7, 9 * 3600 + 60, 17 * 3600)
+        histogram = user.weekday_histogram()
+        starts = histogram.counts('starts', 1)
+        self.assertEqual(len(starts), store.BINS)
+        self.assertEqual(sum(starts), 3)
+        self.assertEqual(starts[9 * 6], 2)
+        self.assertEqual(starts[8 * 6], 0)
+        self.assertEqual(sum(histogram.counts('ends', 0)), 0)
+        intervals = histogram.counts('intervals', 1)
+        self.assertEqual((intervals[8 * 6 - 1], intervals[8 * 6]), (1, 1))
+        self.assertEqual(
+            list(user.weekday_histogram(tuesday + 14, None).counts(
+                'intervals', 1
+            ))[2 * 6],
+            1
+        )
+
+        other = user.weekday_histogram()
+        other.update(histogram)
+        self.assertEqual(sum(other.counts('starts', 1)), 6)
+        self.assertEqual(sum(histogram.counts('starts', 1)), 3)
+
+    def test_occupancy(self):
+        """
+        Test counting entries overlapping time slots
+        """
+        user = store.UserPresence()
+        monday = datetime.date(2013, 9, 30).toordinal()
+        user.add(monday, 9 * 3600, 10 * 3600)
+        user.add(monday + 7, 9 * 3600 + 899, 9 * 3600 + 901)
+        user.add(monday + 14, 100, 100)
+        slots = user.occupancy.counts(0)
+        self.assertEqual(len(slots), store.SLOTS)
+        self.assertEqual(slots[35:41], [0, 2, 2, 1, 1, 0])
+        self.assertEqual(sum(user.occupancy.counts(1)), 0)
+
+        user.add(monday + 7, 23 * 3600, 24 * 3600 - 1)
+        self.assertEqual(user.occupancy.counts(0)[36:38], [1, 1])
+        self.assertEqual(user.occupancy.counts(0)[-1], 1)
+        occupancy = user.weekday_occupancy(monday + 1, None)
+        self.assertEqual(occupancy.counts(0)[36], 0)
+        occupancy.update(user.occupancy)
+        self.assertEqual(occupancy.counts(0)[-1], 2)
+        self.assertEqual(utils.weekday_days(monday, monday + 8),
+                         [2, 2, 1, 1, 1, 1, 1])
+
+    def test_range_totals(self):
+        """
+        Test totals of date ranges equal totals of entries in them
+        """
+        user = store.UserPresence()
+        monday = datetime.date(2013, 9, 30).toordinal()
+        for day in range(10):
+            user.add(monday + day, 3600 * day, 3600 * (day + 8))
+        self.assertIs(user.weekday_occupancy(monday - 1, None),
+                      user.occupancy)
+        for first, last in ((monday + 1, monday + 2), (monday + 1, None),
+                            (None, monday + 8), (monday + 20, None)):
+            occupancy, index = store.Occupancy(), store.WeekdayIndex()
+            for day, start, end in user.rows(first, last):
+                occupancy.add(day, start, end)
+                index.add(day, start, end)
+            self.assertEqual(user.weekday_occupancy(first, last).changes,
+                             occupancy.changes)
+            self.assertEqual(user.weekday_index(first, last).starts,
+                             index.starts)
+        self.assertEqual(user.weekday_index(monday + 1, None).counts[0], 1)
+        self.assertEqual(user.index.counts[0], 2)
+
+    def test_rollup(self):
+        """
+        Test keeping totals per week and month up to date
+        """
+        user = store.UserPresence()
+        monday = datetime.date(2013, 9, 30).toordinal()
+        user.add(monday, 100, 400)
+        user.add(monday + 1, 100, 200)
+        user.add(monday - 14, 100, 300)
+        user.add(monday + 1, 100, 600)
+        week = store.week(monday)
+        self.assertEqual(list(user.weeks.items()), [
+            (week - 2, 1, 200), (week - 1, 0, 0), (week, 2, 800),
+        ])
+        self.assertEqual(list(user.weeks.items(week - 1, week - 1)),
+                         [(week - 1, 0, 0)])
+        self.assertEqual(list(user.weeks.items(week + 1, None)), [])
+        month = store.month(monday)
+        self.assertEqual(month, 2013 * 12 + 8)
+        self.assertEqual(store.month(monday), month)
+        self.assertEqual(store.month(monday + 1), month + 1)
+        self.assertEqual(list(user.months.items()), [
+            (month, 2, 500), (month + 1, 1, 500),
+        ])
+
+        rollup = store.Rollup()
+        rollup.add(week + 3, 50)
+        rollup.update(user.weeks)
+        self.assertEqual(list(rollup.items(week, None)), [
+            (week, 2, 800), (week + 1, 0, 0), (week + 2, 0, 0),
+            (week + 3, 1, 50),
+        ])
+        self.assertEqual(rollup.first, week - 2)
+        self.assertEqual(list(user.weeks.copy().items()),
+                         list(user.weeks.items()))
+
+    def test_user_presence_mapping(self):
+        """
+        Test accessing user presence like a dict of dates
+        """
+        user = store.UserPresence()
+        sample_date = datetime.date(2013, 9, 10)
+        user.add(sample_date.toordinal(), 34745, 64792)
+        self.assertEqual(len(user), 1)
+        self.assertEqual(user.keys(), [sample_date])
+        self.assertIn(sample_date, user)
+        self.assertNotIn(datetime.date(2013, 9, 11), user)
+        self.assertNotIn('2013-09-10', user)
+        self.assertEqual(user[sample_date], {
+            'start': datetime.time(9, 39, 5),
+            'end': datetime.time(17, 59, 52),
+        })
+        with self.assertRaises(KeyError):
+            user[datetime.date(2013, 9, 11)]
+
+    def test_weekday(self):
+        """
+        Test calculating weekday of day ordinal
+        """
+        for day in range(1, 15):
+            sample_date = datetime.date(2013, 9, day)
+            self.assertEqual(
+                store.weekday(sample_date.toordinal()),
+                sample_date.weekday()
+            )
+
+
+class PresenceAnalyzerUsersXMLTestCase(unittest.TestCase):
+    """
+    Users XML parsing tests.
+    """
+
+    def test_iter_users_xml(self):
+        """
+        Test streaming users from XML file
+        """
+        users = utils.iter_users_xml(TEST_USERS_XML)
+        self.assertEqual(next(users), {
+            'user_id': 141,
+            'name': 'Adam P.',
+            'avatar': '/api/images/users/141',
+        })
+        self.assertEqual(len(list(users)), 7)
+
+    def test_read_synthetic_users_xml(self):
+        """
+        Test reading generated users XML file
+        """
+        handle, path = tempfile.mkstemp(suffix='.xml')
+        os.close(handle)
+        try:
+            benchmark.write_users_xml(path, 100)
+            users = utils.read_users_xml(path)
+            self.assertEqual(users, benchmark.load_users_tree(path))
+            self.assertEqual(len(users), 100)
+            self.assertEqual(users[99]['name'], 'User 99.')
+        finally:
+            os.remove(path)
+
+
+class PresenceAnalyzerBenchmarkTestCase(unittest.TestCase):
+    """
+    Benchmark suite tests.
+    """
+
+    def test_write_presence_csv(self):
+        """
+        Test generating synthetic presence data
+        """
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        try:
+            benchmark.write_presence_csv(path, users=3, years=1)
+            data = utils.load_presence_csv(path)
+            self.assertItemsEqual(data.keys(), [0, 1, 2])
+            self.assertTrue(250 <= len(data[0]) <= 262)
+            self.assertEqual(sum(data[0].index.counts[5:]), 0)
+        finally:
+            os.remove(path)
+
+    def test_regressions(self):
+        """
+        Test detecting benchmarks slower than baseline
+        """
+        baseline = {'results': {'a': {'p50': 1.0}, 'b': {'p50': 1.0}}}
+        report = {'results': {
+            'a': {'p50': 1.1}, 'b': {'p50': 1.5}, 'c': {'p50': 9.0},
+        }}
+        self.assertEqual(
+            benchmark.regressions(report, baseline), {'b': (1.0, 1.5)}
+        )
+        self.assertEqual(benchmark.summarize([3, 1, 2])['p50'], 2)
+
+    def test_sample(self):
+        """
+        Test running untimed setup before each sample
+        """
+        calls = []
+        samples = benchmark.sample(
+            lambda: calls.append('call'), 2, lambda: calls.append('setup')
+        )
+        self.assertEqual(len(samples), 2)
+        self.assertEqual(calls, ['setup', 'call'] * 2)
+
+        utils.responses.get(1, 'key', lambda: 'value')
+        benchmark.clear_caches()
+        self.assertEqual(utils.responses.info()['size'], 0)
+
+
+class PresenceAnalyzerSQLiteTestCase(unittest.TestCase):
+    """
+    SQLite storage backend tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, import test data to temporary database.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmpdir, 'presence.sqlite')
+        utils.import_sqlite(TEST_DATA_CSV, self.db_path)
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_SQLITE': self.db_path,
+            'USERS_XML': TEST_USERS_XML,
+        })
+        utils.get_data.cache_clear()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Remove temporary files and restore configuration.
+        """
+        shutil.rmtree(self.tmpdir)
+        main.app.config.update({'STORAGE': 'csv'})
+        utils.get_data.cache_clear()
+
+    def test_store(self):
+        """
+        Test reading aggregates computed by SQL
+        """
+        expected = utils.load_presence_csv(TEST_DATA_CSV)
+        data = sqlstore.SQLiteLoader(self.db_path).load()
+        self.assertEqual(data.keys(), [10, 11])
+        self.assertNotIn(12, data)
+        self.assertEqual(data.row_count(), 9)
+        for user_id in expected:
+            user, other = data[user_id], expected[user_id]
+            self.assertEqual(len(user), len(other))
+            self.assertEqual(list(user.rows()), list(other.rows()))
+            self.assertEqual(list(user.days), list(other.days))
+            for name in store.WeekdayIndex.__slots__:
+                self.assertEqual(getattr(user.index, name),
+                                 getattr(other.index, name))
+            self.assertEqual(user.weekday_histogram().bins,
+                             other.weekday_histogram().bins)
+            self.assertEqual(user.occupancy.changes, other.occupancy.changes)
+            for name in ('weeks', 'months'):
+                self.assertEqual(list(getattr(user, name).items()),
+                                 list(getattr(other, name).items()))
+        first, last = expected[11].days[1], expected[11].days[3]
+        self.assertEqual(list(data[11].rows(first, last)),
+                         list(expected[11].rows(first, last)))
+        self.assertEqual(data[11].span(first, last), (1, 4))
+        self.assertEqual(data[10][datetime.date(2013, 9, 10)],
+                         expected[10][datetime.date(2013, 9, 10)])
+        self.assertNotIn(datetime.date(2013, 9, 9), data[10])
+        self.assertEqual(sum(data.weekday_index([]).counts), 0)
+
+        for user_ids in (None, [11, 12]):
+            self.assertEqual(
+                data.weekday_index(user_ids, first).intervals,
+                expected.weekday_index(user_ids, first).intervals,
+            )
+            self.assertEqual(
+                data.weekday_histogram(user_ids, None, last).bins,
+                expected.weekday_histogram(user_ids, None, last).bins,
+            )
+            self.assertEqual(
+                data.weekday_occupancy(user_ids, first, last).changes,
+                expected.weekday_occupancy(user_ids, first, last).changes,
+            )
+            self.assertEqual(
+                list(data.rollup('month', user_ids).items()),
+                list(expected.rollup('month', user_ids).items()),
+            )
+            self.assertEqual(
+                [sorted(chain(*runs)) for runs in
+                 data.sorted_values('intervals', user_ids, first)],
+                [sorted(chain(*runs)) for runs in
+                 expected.sorted_values('intervals', user_ids, first)],
+            )
+            self.assertEqual(data.day_range(user_ids),
+                             expected.day_range(user_ids))
+
+    def test_reload(self):
+        """
+        Test opening database again when it changes
+        """
+        loader = sqlstore.SQLiteLoader(self.db_path)
+        data = loader.load()
+        self.assertIs(loader.load(), data)
+        time.sleep(0.01)
+        sqlstore.import_rows(self.db_path, [(12, 735000, 100, 200),
+                                            (10, 735122, 100, 200)])
+        new_data = loader.load()
+        self.assertIsNot(new_data, data)
+        self.assertGreater(new_data.generation, data.generation)
+        self.assertEqual(new_data.keys(), [10, 11, 12])
+        self.assertEqual(new_data.row_count(), 10)
+        self.assertEqual(loader.stats()['loads'], 2)
+
+    def test_api(self):
+        """
+        Test API views giving the same results with both storages
+        """
+        urls = [
+            '/api/v1/mean_time_weekday/11',
+            '/api/v1/presence_weekday/10?from=2013-09-11',
+            '/api/v1/presence_start_end/11',
+            '/api/v1/aggregate/mean?field=start',
+            '/api/v1/aggregate/percentile?user_id=10,11&q=25',
+            '/api/v1/batch?user_id=10,11,12',
+            '/api/v1/distribution?from=2013-09-10',
+            '/api/v1/distribution/11',
+            '/api/v1/timeseries/week',
+            '/api/v1/timeseries/month/10',
+            '/api/v1/occupancy?user_id=11',
+            '/api/v1/export?format=ndjson',
+        ]
+        expected = [self.client.get(url).data for url in urls]
+        main.app.config.update({'STORAGE': 'sqlite'})
+        utils.get_data.cache_clear()
+        self.assertIsInstance(utils.get_data(), sqlstore.SQLiteStore)
+        for url, data in zip(urls, expected):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, data, url)
+        self.assertEqual(utils.loader_stats()['rows'], 9)
+
+
+class PresenceAnalyzerInstrumentationTestCase(unittest.TestCase):
+    """
+    Request instrumentation tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, enable instrumentation.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'USERS_XML': TEST_USERS_XML,
+            'INSTRUMENTATION': True,
+            'PROFILING': 'header',
+        })
+        instrumentation.stats.clear()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Disable instrumentation after each test.
+        """
+        main.app.config.update({'INSTRUMENTATION': False, 'PROFILING': None})
+        instrumentation.stats.clear()
+
+    def test_phases(self):
+        """
+        Test splitting request latency into phases
+        """
+        # query string keeps the response out of cache shared with other tests
+        resp = self.client.get('/api/v1/presence_weekday/10?phases')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('aggregate;dur=', resp.headers['Server-Timing'])
+        self.assertIn('serialize;dur=', resp.headers['Server-Timing'])
+        self.assertIn('load;dur=', resp.headers['Server-Timing'])
+
+        resp = self.client.get('/api/v1/stats')
+        data = json.loads(resp.data)
+        self.assertTrue(data['enabled'])
+        stats = data['endpoints']['presence_weekday_view']
+        self.assertEqual(stats['count'], 1)
+        self.assertItemsEqual(
+            stats['phases'].keys(), ['load', 'aggregate', 'serialize'],
+        )
+        self.assertLessEqual(sum(stats['phases'].values()), stats['max'])
+        self.assertEqual(data['profiles'], [])
+
+    def test_nested_phases(self):
+        """
+        Test not counting nested phase in the outer one
+        """
+        timings = {'phases': collections.defaultdict(float), 'stack': []}
+        instrumentation._current.timings = timings
+        try:
+            with instrumentation.phase('aggregate'):
+                with instrumentation.phase('load'):
+                    time.sleep(0.05)
+        finally:
+            instrumentation._current.timings = None
+        self.assertLess(timings['phases']['aggregate'], 0.04)
+        self.assertGreaterEqual(timings['phases']['load'], 0.04)
+
+    def test_profile(self):
+        """
+        Test capturing profile requested by header
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertNotIn('X-Profile-Id', resp.headers)
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11', headers={'X-Profile': '1'},
+        )
+        profile_id = resp.headers['X-Profile-Id']
+
+        data = json.loads(self.client.get('/api/v1/stats').data)
+        self.assertEqual(len(data['profiles']), 1)
+        profile = data['profiles'][0]
+        self.assertEqual(profile['id'], profile_id)
+        self.assertEqual(profile['url'], '/api/v1/presence_weekday/11?')
+        self.assertIn('function calls', profile['profile'])
+
+    def test_metrics(self):
+        """
+        Test exposing metrics in Prometheus format
+        """
+        self.client.get('/api/v1/presence_weekday/10')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        lines = resp.data.splitlines()
+        self.assertIn('# TYPE presence_request_duration_seconds histogram',
+                      lines)
+        self.assertIn('presence_requests_total'
+                      '{endpoint="presence_weekday_view"} 1.0', lines)
+        self.assertIn('presence_request_duration_seconds_bucket'
+                      '{endpoint="presence_weekday_view",le="+Inf"} 1.0',
+                      lines)
+        self.assertIn('presence_data_rows 9.0', lines)
+        self.assertIn('presence_csv_rejected_lines 0.0', lines)
+        self.assertIn('presence_cache_hits_total{cache="get_data"}',
+                      resp.data)
+        samples = dict(
+            line.rsplit(' ', 1) for line in lines if not line.startswith('#')
+        )
+        self.assertGreater(float(samples['process_resident_memory_bytes']),
+                           0)
+
+    def test_disabled(self):
+        """
+        Test not collecting statistics by default
+        """
+        main.app.config.update({'INSTRUMENTATION': False})
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10', headers={'X-Profile': '1'},
+        )
+        self.assertNotIn('Server-Timing', resp.headers)
+        self.assertNotIn('X-Profile-Id', resp.headers)
+        data = json.loads(self.client.get('/api/v1/stats').data)
+        self.assertEqual(data['endpoints'], {})
+
+
 def suite():
     """
     Default test suite.
@@ -207,6 +1760,14 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerLoaderTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerMultiFileLoaderTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerSnapshotTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerUsersXMLTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerBenchmarkTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerSQLiteTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerInstrumentationTestCase))
     return suite
 
 
@@ -3,61 +3,336 @@
 Helper functions used in views.
 """
 
+import calendar
 import csv
+import errno
+import glob
+import os
+from base64 import b64decode, b64encode
+from calendar import timegm
+from hashlib import sha1
 from json import dumps
-from functools import wraps
-from datetime import datetime
+from collections import OrderedDict
+from functools import partial, wraps
+from itertools import chain, izip
+from datetime import date
+from multiprocessing import Pool, cpu_count
 from lxml import etree
-from flask import Response
-from collections import defaultdict
+from flask import Response, request
 import threading
 import time
+import zlib
 from presence_analyzer.main import app
+from presence_analyzer import snapshot, sqlstore
+from presence_analyzer.instrumentation import phase, timed_phase
+from presence_analyzer.sqlstore import SQLiteLoader
+from presence_analyzer.store import (
+    BIN_SECONDS,
+    PresenceStore,
+    SLOT_SECONDS,
+    SLOTS,
+    combine,
+    month,
+    select,
+    time_from_seconds,
+    week,
+    weekday,
+)
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 
-def jsonify(function):
+class JSON(str):
+    """
+    Already serialized JSON, which jsonify sends as it is.
+    """
+
+
+def jsonify(function=None, cached=False):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    With cached=True serialized bodies are kept per view and requested URL
+    until presence data is reloaded, together with their gzip compressed
+    variants sent to clients accepting them.
     """
+    if function is None:
+        return partial(jsonify, cached=cached)
+
     @wraps(function)
     def inner(*args, **kwargs):
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
+        if not cached:
+            return Response(_render(function, args, kwargs),
+                            mimetype='application/json')
+
+        bodies = responses.get(
+            get_data().generation,
+            (function.__name__, request.full_path),
+            lambda: {'identity': _render(function, args, kwargs)},
+        )
+        encoding = _encoding(bodies['identity'])
+        if encoding not in bodies:
+            with phase('serialize'):
+                bodies[encoding] = gzip(bodies['identity'])
+        response = Response(bodies[encoding], mimetype='application/json')
+        if encoding != 'identity':
+            response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def cached_encoding():
+        """
+        Returns encoding of response to current request if its body is
+        already cached, None otherwise. The view is not called.
+        """
+        bodies = responses.peek(
+            get_data().generation, (function.__name__, request.full_path)
+        )
+        return _encoding(bodies['identity']) if bodies else None
+
+    inner.compressed = cached
+    inner.cached_encoding = cached_encoding
     return inner
 
 
+def _encoding(body):
+    """
+    Returns content encoding of cached response with given body for
+    current request.
+    """
+    if len(body) >= app.config.get('GZIP_MIN_SIZE', 512) \
+            and request.accept_encodings['gzip']:
+        return 'gzip'
+    return 'identity'
+
+
+def _render(function, args, kwargs):
+    """
+    Calls view function and serializes its result, timing both phases.
+    """
+    with phase('aggregate'):
+        result = function(*args, **kwargs)
+    with phase('serialize'):
+        return _serialize(result)
+
+
+def _serialize(result):
+    """
+    Returns JSON representation of view result.
+    """
+    if isinstance(result, JSON):
+        return result
+    return dumps(result)
+
+
+def gzip(body):
+    """
+    Compresses body in gzip format.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def data_version():
+    """
+    Returns version and modification time of presence data.
+    """
+    data = get_data()
+    return data.version, data.modified
+
+
+def users_version():
+    """
+    Returns version and modification time of users directory.
+    """
+    users = get_users()
+    return users.version, users.modified
+
+
+def conditional(version):
+    """
+    Adds ETag, Last-Modified and Cache-Control headers to response.
+
+    The ETag is derived from data version returned by 'version' function
+    and from requested URL, gzip compressed variants get '-gzip' suffix.
+    Conditional requests matching it get '304 Not Modified' without
+    calling the wrapped view.
+    """
+    def decorator(function):
+        compressed = getattr(function, 'compressed', False)
+
+        @wraps(function)
+        def inner(*args, **kwargs):
+            tag, modified = version()
+            etag = sha1('%s %s' % (tag, request.full_path)).hexdigest()
+            modified = int(modified) if modified is not None else None
+            encodings = ['identity']
+            if compressed and request.accept_encodings['gzip']:
+                encodings.append('gzip')
+
+            response = None
+            if request.if_none_match:
+                for encoding in encodings:
+                    if request.if_none_match.contains(
+                            variant_etag(etag, encoding)):
+                        response = Response(status=304)
+                        break
+            elif request.if_modified_since and modified is not None:
+                since = timegm(request.if_modified_since.utctimetuple())
+                if modified <= since:
+                    # client has no tag telling which variant it has, so
+                    # it is taken from cached body, if any
+                    encoding = 'identity'
+                    if compressed:
+                        encoding = function.cached_encoding() or encoding
+                    response = Response(status=304)
+
+            if response is None:
+                response = function(*args, **kwargs)
+                encoding = response.content_encoding or 'identity'
+            elif compressed:
+                # 304 is sent with validator and Vary of matching 200
+                response.vary.add('Accept-Encoding')
+            response.set_etag(variant_etag(etag, encoding))
+            if modified is not None:
+                response.last_modified = modified
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config.get(
+                'CACHE_MAX_AGE', 0
+            )
+            return response
+        return inner
+    return decorator
+
+
+def variant_etag(etag, encoding):
+    """
+    Returns ETag of response body in given content encoding. Compressed
+    variant has different bytes, so different tag.
+    """
+    if encoding == 'identity':
+        return etag
+    return '%s-%s' % (etag, encoding)
+
+
 def cache(cache_time):
     """
-    Caches result od function for given time
+    Caches result od function for given time.
+
+    The time is given in seconds or as function returning them, e.g. to
+    read it from configuration. Only the first call for given arguments
+    waits for the function. Once the result expires, it is still served
+    while one background thread computes the new one, which then replaces
+    it. Wrapped function gets cache_info() returning hit, miss, stale and
+    refresh statistics.
     """
-    cached = defaultdict(dict)
+    cached = {}
     lock = threading.Lock()
+    stats = {
+        'hits': 0,
+        'misses': 0,
+        'stale': 0,
+        'refreshes': 0,
+        'refresh_errors': 0,
+        'refresh_seconds': 0.0,
+        'last_refresh_seconds': 0.0,
+    }
 
-    def is_cache_expired(function_name):
-        return (time.time() - cached[function_name]['created']) > cache_time
+    def count(name, value=1):
+        with lock:
+            stats[name] += value
 
     def decorator(function):
+        def refresh(entry, args, kwargs):
+            started = time.time()
+            try:
+                data = function(*args, **kwargs)
+            except Exception:  # pylint: disable-msg=W0703
+                log.exception('Refreshing cache of %r failed', function)
+                count('refresh_errors')
+            else:
+                entry['value'] = (data, time.time())
+                duration = time.time() - started
+                with lock:
+                    stats['refreshes'] += 1
+                    stats['refresh_seconds'] += duration
+                    stats['last_refresh_seconds'] = duration
+            finally:
+                entry['refreshing'] = False
+
         @wraps(function)
         def inner(*args, **kwargs):
-            func_name = repr(function) + repr(args) + repr(kwargs)
+            key = repr(args) + repr(kwargs)
             with lock:
-                if func_name not in cached or is_cache_expired(func_name):
-                    cached[func_name]['data'] = function(*args, **kwargs)
-                    cached[func_name]['created'] = time.time()
-                return cached[func_name]['data']
+                entry = cached.get(key)
+                if entry is None:
+                    entry = cached[key] = {
+                        'value': None,
+                        'refreshing': False,
+                        'lock': threading.Lock(),
+                    }
+
+            if entry['value'] is None:
+                with entry['lock']:
+                    if entry['value'] is None:
+                        count('misses')
+                        entry['value'] = (function(*args, **kwargs),
+                                          time.time())
+                        return entry['value'][0]
+
+            data, created = entry['value']
+            limit = cache_time() if callable(cache_time) else cache_time
+            if time.time() - created <= limit:
+                count('hits')
+                return data
+
+            count('stale')
+            with lock:
+                if entry['refreshing']:
+                    return data
+                entry['refreshing'] = True
+            thread = threading.Thread(
+                target=refresh,
+                args=(entry, args, kwargs),
+                name='cache-refresh-%s' % function.__name__,
+            )
+            thread.daemon = True
+            thread.start()
+            return data
+
+        def cache_info():
+            """
+            Returns cache statistics and age of the oldest cached value.
+            """
+            with lock:
+                info = dict(stats)
+                values = [entry['value'] for entry in cached.itervalues()]
+            created = [value[1] for value in values if value is not None]
+            info['age'] = time.time() - min(created) if created else 0.0
+            return info
+
+        def cache_clear():
+            """
+            Drops all cached values.
+            """
+            with lock:
+                cached.clear()
+
+        inner.cache_info = cache_info
+        inner.cache_clear = cache_clear
         return inner
     return decorator
 
 
-@cache(600)
+@timed_phase('load')
+@cache(lambda: app.config.get('DATA_CACHE_TIME', 600))
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
 
-    It creates structure like this:
+    It creates PresenceStore mapping user_id to UserPresence, which keeps
+    days and start/end times in typed arrays and can be accessed like this:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
@@ -70,37 +345,574 @@ def get_data():
             },
         }
     }
+
+    Only lines appended to the file since the previous call are parsed,
+    see PresenceLoader.
+
+    DATA_CSV can be also a directory or a glob pattern, in which case all
+    matching files are loaded, see MultiFileLoader.
+
+    With STORAGE set to 'sqlite' data is read from DATA_SQLITE database
+    instead, see SQLiteStore. With 'snapshot' it is mapped from snapshot
+    of DATA_CSV kept up to date by DataService, see SnapshotLoader.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    key = _storage_key()
+    with _loaders_lock:
+        loader = _loaders.get(key)
+        if loader is None:
+            storage, path = key
+            loader = _loaders[key] = STORAGES[storage][1](path)
+    return loader.load()
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def _csv_loader(path, processes=1):
+    """
+    Creates loader of CSV file, directory or glob pattern of files.
+
+    Files are parsed in-process by default: forking pool of 'processes'
+    processes is safe only before other threads are started, so web
+    server does not do it.
+    """
+    if os.path.isdir(path) or glob.has_magic(path):
+        return MultiFileLoader(path, processes)
+    return PresenceLoader(path)
+
+
+def _snapshot_loader(path):
+    """
+    Creates loader of snapshot of CSV file written by DataService.
+    """
+    return SnapshotLoader(path)
+
+
+# storage backends: config option with location of presence data and
+# loader factory; load() of the loader returns PresenceStore or other
+# mapping of user_id to users with the interface of UserPresence, which
+# has the group aggregate methods of PresenceStore
+STORAGES = {
+    'csv': ('DATA_CSV', _csv_loader),
+    'snapshot': ('DATA_CSV', _snapshot_loader),
+    'sqlite': ('DATA_SQLITE', SQLiteLoader),
+}
+
+
+def _storage_key():
+    """
+    Returns configured storage backend and location of presence data.
+    """
+    storage = app.config.get('STORAGE', 'csv')
+    if storage not in STORAGES:
+        raise ValueError('Unknown storage: %r' % storage)
+    return storage, app.config[STORAGES[storage][0]]
+
+
+def loader_stats():
+    """
+    Returns statistics of the loader of presence data, or None if it was
+    not loaded yet.
+    """
+    with _loaders_lock:
+        loader = _loaders.get(_storage_key())
+    return loader.stats() if loader is not None else None
+
+
+def data_files(source):
+    """
+    Returns sorted paths of CSV files in given directory or matching given
+    glob pattern.
+    """
+    if os.path.isdir(source):
+        source = os.path.join(source, '*.csv')
+    return sorted(glob.glob(source))
+
+
+def _parse_file(path):
+    """
+    Parses whole CSV file and returns parser state and PresenceStore.
+    Used in worker processes of MultiFileLoader.
+    """
+    loader = PresenceLoader(path, use_snapshot=False)
+    data = loader.load()
+    return loader.state(), data
+
+
+class MultiFileLoader(object):
+    """
+    Loads presence data split into many CSV files.
+
+    Each file has its own PresenceLoader, so only files which changed
+    are parsed again. Files which have to be parsed whole are parsed in
+    a pool of 'processes' processes, as long as the process has no other
+    threads; locks held by them at fork time would stay locked in the
+    pool processes. Entries from later files (in path
+    order) replace entries for the same day from earlier ones.
+    """
+
+    def __init__(self, source, processes=1):
+        self.source = source
+        self.processes = processes
+        self.loaders = {}
+        self.generations = None
+        self.data = None
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.lock = threading.Lock()
 
+    def load(self):
+        """
+        Returns PresenceStore with current content of all the files.
+        """
+        with self.lock:
+            started = time.time()
+            paths = data_files(self.source)
+            self.loaders = {
+                path: self.loaders.get(path) or PresenceLoader(path)
+                for path in paths
+            }
+            rebuild = [
+                path for path in paths
+                if self.loaders[path].pending() == 'rebuild'
+            ]
+            if len(rebuild) > 1 and self.processes > 1 and \
+                    threading.active_count() == 1:
+                self._parse_in_pool(rebuild)
+
+            stores = [self.loaders[path].load() for path in paths]
+            generations = [store.generation for store in stores]
+            if generations != self.generations:
+                self.data = combine(stores)
+                self.data.version = sha1(' '.join(
+                    store.version for store in stores
+                )).hexdigest()
+                self.data.modified = max(
+                    [store.modified for store in stores] or [None]
+                )
+                self.generations = generations
+                self.loads += 1
+                self.load_seconds = time.time() - started
+            return self.data
+
+    def stats(self):
+        """
+        Returns amount of loads, duration of the last one, and amounts of
+        rows and rejected lines of all the files.
+        """
+        with self.lock:
+            loaders = self.loaders.values()
+            return {
+                'loads': self.loads,
+                'load_seconds': self.load_seconds,
+                'rows': self.data.row_count() if self.data else 0,
+                'users': len(self.data) if self.data else 0,
+                'rejected': sum(loader.rejected for loader in loaders),
+            }
+
+    def _parse_in_pool(self, paths):
+        """
+        Parses given files in worker processes.
+        """
+        pool = Pool(min(self.processes, len(paths)))
+        try:
+            results = pool.map(_parse_file, paths)
+        finally:
+            pool.close()
+            pool.join()
+        for path, (state, data) in izip(paths, results):
+            self.loaders[path].install(state, data)
+        log.debug('Parsed %d files in %d processes',
+                  len(paths), min(self.processes, len(paths)))
+
+
+class PresenceLoader(object):
+    """
+    Loads presence CSV file, parsing only lines appended since last load.
+
+    The file is fully re-parsed only when it was truncated, rotated
+    (replaced by file with another inode) or rewritten in place. On first
+    load data and parser state are restored from snapshot file, if any.
+    """
+    # amount of bytes before last offset used to detect in place rewrites
+    check_size = 64
+
+    def __init__(self, path, use_snapshot=True):
+        self.path = path
+        self.use_snapshot = use_snapshot
+        self.data = None
+        self.inode = None
+        self.size = None
+        self.mtime = None
+        self.offset = 0
+        self.lines = 0
+        self.rejected = 0
+        self.check = ''
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Returns PresenceStore with current content of the file.
+        """
+        with self.lock:
+            if self.data is None and self.use_snapshot:
+                self._restore()
+            stat = os.stat(self.path)
+            action = self._action(stat)
+            if action is not None:
+                self._parse(stat, rebuild=action == 'rebuild')
+            return self.data
+
+    def pending(self):
+        """
+        Returns what the next load() will do: 'rebuild', 'append' or None
+        when the file has not changed.
+        """
+        with self.lock:
+            if self.data is None and self.use_snapshot:
+                self._restore()
+            return self._action(os.stat(self.path))
+
+    def stats(self):
+        """
+        Returns amount of parses, duration of the last one, and amounts of
+        rows and of lines rejected as malformed.
+        """
+        with self.lock:
+            return {
+                'loads': self.loads,
+                'load_seconds': self.load_seconds,
+                'rows': self.data.row_count() if self.data else 0,
+                'users': len(self.data) if self.data else 0,
+                'rejected': self.rejected,
+            }
+
+    def _action(self, stat):
+        """
+        Decides whether file with given stat has to be parsed again.
+        """
+        if self.data is None or stat.st_ino != self.inode:
+            return 'rebuild'
+        elif stat.st_size == self.size:
+            if stat.st_mtime != self.mtime:
+                return 'rebuild'
+            return None
+        elif stat.st_size < self.offset:
+            return 'rebuild'
+        return 'append'
+
+    def state(self):
+        """
+        Returns JSON serializable state of the parser.
+        """
+        return {
+            'inode': self.inode,
+            'size': self.size,
+            'mtime': self.mtime,
+            'offset': self.offset,
+            'lines': self.lines,
+            'rejected': self.rejected,
+            'check': b64encode(self.check),
+        }
+
+    def install(self, state, data):
+        """
+        Replaces data and parser state, e.g. with ones parsed by another
+        process.
+        """
+        with self.lock:
+            self._set_state(state)
+            self.data = data
+            self._set_version()
+
+    def _set_state(self, state):
+        """
+        Sets parser state returned by state().
+        """
+        self.inode = state['inode']
+        self.size = state['size']
+        self.mtime = state['mtime']
+        self.offset = state['offset']
+        self.lines = state['lines']
+        self.rejected = state.get('rejected', 0)
+        self.check = b64decode(state['check'])
+
+    def _restore(self):
+        """
+        Restores data and parser state from snapshot of the file.
+        """
+        path = snapshot.snapshot_path(self.path)
+        if not os.path.exists(path):
+            return
+        try:
+            data, meta = snapshot.read(path)
+            self._set_state(meta['csv'])
+        except (EnvironmentError, ValueError, KeyError, TypeError,
+                snapshot.SnapshotError):
+            log.warning('Cannot read snapshot %s', path, exc_info=True)
+            return
+        self.data = data
+        self._set_version()
+        log.debug('Restored %s from snapshot', self.path)
+
+    def _parse(self, stat, rebuild):
+        """
+        Parses the whole file or only its new tail and updates the store.
+        """
+        started = time.time()
+        with open(self.path, 'rb') as csvfile:
+            if not rebuild:
+                csvfile.seek(self.offset - len(self.check))
+                if csvfile.read(len(self.check)) != self.check:
+                    log.info('%s was rewritten, reloading it', self.path)
+                    rebuild = True
+            if rebuild:
+                self.offset = 0
+                self.lines = 0
+                self.rejected = 0
+            csvfile.seek(self.offset)
+            tail = _Tail(csvfile)
+
+            # the last line may be still being written, so it is parsed now
+            # and once again next time; entries for the same day replace
+            # each other
+            rejected = []
+            rows = parse_presence_lines(tail, self.lines, rejected)
+            if rebuild:
+                self.data = PresenceStore().merged(rows)
+            else:
+                self.data = self.data.merged(rows)
+            log.debug('Parsed %d bytes of %s', tail.size, self.path)
+
+            self.lines += tail.lines
+            # incomplete last line is counted once it is finished
+            self.rejected += sum(1 for i in rejected if i < self.lines)
+            self.offset += tail.complete
+            check_start = max(0, self.offset - self.check_size)
+            csvfile.seek(check_start)
+            self.check = csvfile.read(self.offset - check_start)
+
+        self.inode = stat.st_ino
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self._set_version()
+        self.loads += 1
+        self.load_seconds = time.time() - started
+
+    def _set_version(self):
+        """
+        Marks data with version and modification time of parsed file.
+        """
+        self.data.version = '%x-%x-%r' % (self.inode, self.size, self.mtime)
+        self.data.modified = self.mtime
+
+
+class _Tail(object):
+    """
+    Iterates over lines of file one by one, counting read bytes, complete
+    lines and bytes up to the end of the last complete line.
+    """
+
+    def __init__(self, lines):
+        self.source = lines
+        self.size = 0
+        self.complete = 0
+        self.lines = 0
+
+    def __iter__(self):
+        for line in self.source:
+            self.size += len(line)
+            if line.endswith('\n'):
+                self.complete = self.size
+                self.lines += 1
+            yield line
+
+
+class DataUnavailable(Exception):
+    """
+    Presence data or users are not available yet, such as before
+    DataService writes the first snapshot.
+    """
+
+
+def _snapshot_state(path):
+    """
+    Returns (inode, size, modification time) of snapshot file, or None if
+    it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+class SnapshotLoader(object):
+    """
+    Maps snapshot of presence CSV file again whenever it is replaced.
+
+    The file is parsed only by DataService, which writes the snapshot.
+    All processes mapping it share its pages, so memory does not grow
+    with the amount of worker processes.
+    """
+
+    def __init__(self, csv_path):
+        self.path = snapshot.snapshot_path(csv_path)
+        self.data = None
+        self.meta = {}
+        self.state = None
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Returns PresenceStore mapped from current snapshot. Raises
+        DataUnavailable until the snapshot is written; once mapped, data
+        stays available even if the file is removed.
+        """
+        with self.lock:
+            started = time.time()
+            state = _snapshot_state(self.path)
+            if state is None:
+                if self.data is None:
+                    raise DataUnavailable('%s is not written yet' % self.path)
+                return self.data
+            if state != self.state:
+                data, meta = snapshot.read(self.path)
+                # versioned like by the loader of DATA_CSV, so that ETags
+                # do not depend on the way data was loaded
+                data.version = meta.get('version') or '%x-%x-%r' % state
+                data.modified = meta.get('modified', state[2])
+                self.data = data
+                self.meta = meta
+                self.state = state
+                self.loads += 1
+                self.load_seconds = time.time() - started
+                log.debug('Mapped %s', self.path)
+            return self.data
+
+    def stats(self):
+        """
+        Returns amount of loads, duration of the last one, and amounts of
+        rows and of lines rejected by DataService.
+        """
+        with self.lock:
+            data = self.data
+            return {
+                'loads': self.loads,
+                'load_seconds': self.load_seconds,
+                'rows': data.row_count() if data else 0,
+                'users': len(data) if data else 0,
+                'rejected': self.meta.get('rejected', 0),
+            }
+
+
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+
+def load_presence_csv(path):
+    """
+    Loads presence entries from given CSV file into PresenceStore.
+    """
+    data = PresenceStore()
+    with open(path, 'r') as csvfile:
+        for user_id, day, start, end in parse_presence_lines(csvfile):
+            data.add(user_id, day, start, end)
     return data
 
 
+def import_sqlite(csv_path, db_path):
+    """
+    Imports presence entries from CSV file into SQLite database. Returns
+    amount of imported rows.
+    """
+    with open(csv_path, 'r') as csvfile:
+        return sqlstore.import_rows(db_path, parse_presence_lines(csvfile))
+
+
+def parse_presence_lines(lines, first_line=0, rejected=None):
+    """
+    Parses lines in fixed ``id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS`` layout.
+
+    Yields (user_id, day ordinal, start, end) tuples with start and end
+    in seconds since midnight. Header, footer and malformed lines are
+    skipped; numbers of the malformed ones are appended to 'rejected'
+    list, if given.
+    """
+    days = {}
+    for i, line in enumerate(lines, first_line):
+        row = line.rstrip('\r\n').split(',')
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            user_id = int(row[0])
+            day = days.get(row[1])
+            if day is None:
+                day = days[row[1]] = parse_date(row[1])
+            start = parse_time(row[2])
+            end = parse_time(row[3])
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            if rejected is not None:
+                rejected.append(i)
+            continue
+
+        yield user_id, day, start, end
+
+
+def parse_date(value):
+    """
+    Parses YYYY-MM-DD string into day ordinal.
+    """
+    if len(value) != 10 or value[4] != '-' or value[7] != '-':
+        raise ValueError('Invalid date: %r' % value)
+    return date(int(value[:4]), int(value[5:7]), int(value[8:])).toordinal()
+
+
+def parse_time(value):
+    """
+    Parses HH:MM:SS string into amount of seconds since midnight.
+    """
+    if len(value) != 8 or value[2] != ':' or value[5] != ':':
+        raise ValueError('Invalid time: %r' % value)
+    hours, minutes, seconds = int(value[:2]), int(value[3:5]), int(value[6:])
+    if hours > 23 or minutes > 59 or seconds > 59:
+        raise ValueError('Invalid time: %r' % value)
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def weekday_rows(items):
+    """
+    Iterates over (weekday, start, end) of presence entries, where start
+    and end are given in seconds since midnight.
+
+    Accepts UserPresence as well as plain {date: {'start', 'end'}} dicts.
+    """
+    if hasattr(items, 'rows'):
+        for day, start, end in items.rows():
+            yield weekday(day), start, end
+        return
+
+    for day in items:
+        yield (
+            day.weekday(),
+            seconds_since_midnight(items[day]['start']),
+            seconds_since_midnight(items[day]['end']),
+        )
+
+
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
     """
     result = {i: [] for i in range(7)}
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for day, start, end in weekday_rows(items):
+        result[day].append(end - start)
     return result
 
 
@@ -109,14 +921,501 @@ def group_start_end_by_weekday(items):
     Groups start and end by weekday.
     """
     result = {i: {'starts': [], 'ends': []} for i in range(7)}
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()]['starts'].append(seconds_since_midnight(start))
-        result[date.weekday()]['ends'].append(seconds_since_midnight(end))
+    for day, start, end in weekday_rows(items):
+        result[day]['starts'].append(start)
+        result[day]['ends'].append(end)
+    return result
+
+
+class AggregateCache(object):
+    """
+    Bounded LRU cache of values computed from presence data.
+
+    Values expire after 'ttl' seconds and all of them are dropped once
+    presence data of newer generation is used.
+    """
+
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = None
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, generation, key, compute):
+        """
+        Returns cached value for given key or stores result of compute().
+        """
+        now = time.time()
+        with self.lock:
+            if self.generation is None or generation > self.generation:
+                self.values.clear()
+                self.generation = generation
+            elif generation < self.generation:
+                # request still holding older data, e.g. while it is being
+                # refreshed; its values are neither served nor stored
+                self.misses += 1
+                return compute()
+            try:
+                value, created = self.values.pop(key)
+            except KeyError:
+                pass
+            else:
+                if now - created <= self.ttl:
+                    self.values[key] = (value, created)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+
+        value = compute()
+        with self.lock:
+            if generation == self.generation:
+                self.values[key] = (value, now)
+                while len(self.values) > self.maxsize:
+                    self.values.popitem(last=False)
+        return value
+
+    def peek(self, generation, key):
+        """
+        Returns cached value for given key or None, without computing it
+        or counting hit or miss.
+        """
+        now = time.time()
+        with self.lock:
+            if generation != self.generation or key not in self.values:
+                return None
+            value, created = self.values[key]
+            return value if now - created <= self.ttl else None
+
+    def clear(self):
+        """
+        Drops all cached values, so that data of any generation can be
+        cached again.
+        """
+        with self.lock:
+            self.values.clear()
+            self.generation = None
+
+    def configure(self, maxsize, ttl):
+        """
+        Changes size limit and time to live of cached values.
+        """
+        with self.lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+
+    def info(self):
+        """
+        Returns cache statistics.
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / requests if requests else 0.0,
+                'size': len(self.values),
+                'maxsize': self.maxsize,
+            }
+
+
+aggregates = AggregateCache()  # pylint: disable-msg=C0103
+responses = AggregateCache()  # pylint: disable-msg=C0103
+
+
+def user_aggregate(function):
+    """
+    Caches result of function(data, user_id, *args) computed from presence
+    data of single user, until data of newer generation is loaded.
+    """
+    @wraps(function)
+    def inner(data, user_id, *args):
+        return aggregates.get(
+            data.generation,
+            (function.__name__, user_id) + args,
+            lambda: function(data, user_id, *args),
+        )
+    return inner
+
+
+def weekday_index(data, user_id, first=None, last=None):
+    """
+    Returns WeekdayIndex of given user entries between given day ordinals.
+    """
+    if first is None and last is None:
+        return data[user_id].index
+    return _range_weekday_index(data, user_id, first, last)
+
+
+@user_aggregate
+def _range_weekday_index(data, user_id, first, last):
+    """
+    Builds and caches WeekdayIndex of user entries in given date range.
+    """
+    return data[user_id].weekday_index(first, last)
+
+
+def group_histogram(data, user_ids, first=None, last=None):
+    """
+    Returns WeekdayHistogram of entries of given users between given day
+    ordinals.
+    """
+    return data.weekday_histogram(user_ids, first, last)
+
+
+def distribution(data, user_ids, first=None, last=None, quantiles=(50, 90)):
+    """
+    Returns percentiles and non-empty histogram bins of start, end and
+    interval per weekday of entries of given users between given day
+    ordinals.
+
+    Percentiles are computed from users' sorted values, the same way as
+    by group_aggregate. Bins are given as (lower bound in seconds, count)
+    pairs, each bin is BIN_SECONDS wide.
+    """
+    histogram = group_histogram(data, user_ids, first, last)
+    values = {
+        field: group_values(data, user_ids, field, first, last)
+        for field in FIELDS
+    }
+    result = []
+    for weekday in range(7):
+        fields = {}
+        for field, name in FIELDS.iteritems():
+            counts = histogram.counts(name, weekday)
+            fields[field] = {
+                'count': sum(counts),
+                'percentiles': [
+                    (q, runs_percentile(values[field][weekday], q))
+                    for q in quantiles
+                ],
+                'histogram': [
+                    (n * BIN_SECONDS, count)
+                    for n, count in enumerate(counts) if count
+                ],
+            }
+        fields['weekday'] = calendar.day_abbr[weekday]
+        result.append(fields)
+    return result
+
+
+def group_occupancy(data, user_ids, first=None, last=None):
+    """
+    Returns Occupancy with summed changes of given users.
+    """
+    return data.weekday_occupancy(user_ids, first, last)
+
+
+def day_range(data, user_ids):
+    """
+    Returns ordinals of the first and the last day with entries of given
+    users, or (0, -1) if there are none.
+    """
+    return data.day_range(user_ids)
+
+
+def weekday_days(first, last):
+    """
+    Returns amounts of days of each weekday between given day ordinals
+    (inclusive).
+    """
+    total = max(0, last - first + 1)
+    result = [total // 7] * 7
+    for day in xrange(first, first + total % 7):
+        result[weekday(day)] += 1
     return result
 
 
+def occupancy(data, user_ids, first=None, last=None):
+    """
+    Returns mean amount of given users present in each SLOT_SECONDS long
+    slot of each weekday, between given day ordinals.
+
+    Means are taken over all calendar days of the weekday in the range,
+    which defaults to days between the first and the last entry of the
+    users. Without a range users' kept occupancy is summed; with one, each
+    user's entries in the range or outside of it, whichever are fewer,
+    are scanned, so callers should cache the result.
+    """
+    user_ids = [user_id for user_id in user_ids if user_id in data]
+    lowest, highest = first, last
+    if first is None or last is None:
+        lowest, highest = day_range(data, user_ids)
+    days = weekday_days(
+        lowest if first is None else first,
+        highest if last is None else last,
+    )
+    changes = group_occupancy(data, user_ids, first, last)
+    return {
+        'slots': [
+            time_from_seconds(slot * SLOT_SECONDS).strftime('%H:%M')
+            for slot in range(SLOTS)
+        ],
+        'weekdays': [calendar.day_abbr[i] for i in range(7)],
+        'days': days,
+        'occupancy': [
+            [float(count) / days[i] if days[i] else 0
+             for count in changes.counts(i)]
+            for i in range(7)
+        ],
+    }
+
+
+def week_label(bucket):
+    """
+    Returns ISO week of given week number in YYYY-Www format.
+    """
+    year, number, _ = date.fromordinal(bucket * 7 + 1).isocalendar()
+    return '%d-W%02d' % (year, number)
+
+
+def month_label(bucket):
+    """
+    Returns month of given month number in YYYY-MM format.
+    """
+    year, number = divmod(bucket, 12)
+    return '%d-%02d' % (year, number + 1)
+
+
+# time series periods: UserPresence rollup attribute, bucket of day ordinal
+# and label of bucket
+PERIODS = {
+    'week': ('weeks', week, week_label),
+    'month': ('months', month, month_label),
+}
+
+
+def group_rollup(data, user_ids, period):
+    """
+    Returns Rollup with summed buckets of given period of given users.
+    """
+    return data.rollup(period, user_ids)
+
+
+def timeseries(rollup, period, first=None, last=None):
+    """
+    Returns (label, days, presence) of buckets of Rollup of given period
+    which overlap given day ordinals, presence in seconds.
+    """
+    _, bucket, label = PERIODS[period]
+    return [
+        (label(number), count, total)
+        for number, count, total in rollup.items(
+            bucket(first) if first is not None else None,
+            bucket(last) if last is not None else None,
+        )
+    ]
+
+
+def mean_time_weekday(index):
+    """
+    Returns mean presence time per weekday from WeekdayIndex.
+    """
+    return [
+        (calendar.day_abbr[weekday], index.mean(index.intervals, weekday))
+        for weekday in range(7)
+    ]
+
+
+def presence_weekday(index):
+    """
+    Returns total presence time per weekday from WeekdayIndex, with
+    chart header.
+    """
+    result = [(calendar.day_abbr[weekday], index.intervals[weekday])
+              for weekday in range(7)]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(index):
+    """
+    Returns mean start and end of presence per weekday from WeekdayIndex.
+    """
+    return [
+        (
+            calendar.day_abbr[weekday],
+            index.mean(index.starts, weekday),
+            index.mean(index.ends, weekday)
+        )
+        for weekday in range(7)
+    ]
+
+
+# metrics available in batch requests
+METRICS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday,
+    'presence_start_end': presence_start_end,
+}
+
+
+# WeekdayIndex totals of values which can be aggregated over many users
+FIELDS = {
+    'interval': 'intervals',
+    'start': 'starts',
+    'end': 'ends',
+}
+
+
+def group_index(data, user_ids, first=None, last=None):
+    """
+    Returns WeekdayIndex with summed totals of given users.
+    """
+    return data.weekday_index(user_ids, first, last)
+
+
+def group_values(data, user_ids, field, first=None, last=None):
+    """
+    Returns sorted values of given field of given users: list of sorted
+    runs, one per user, for each weekday.
+    """
+    return data.sorted_values(FIELDS[field], user_ids, first, last)
+
+
+def percentile(values, q):
+    """
+    Returns q-th percentile of sorted values, interpolating linearly
+    between closest ranks. Returns zero for empty values.
+    """
+    if not values:
+        return 0
+    position = (len(values) - 1) * q / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (
+        position - lower
+    )
+
+
+def runs_percentile(runs, q):
+    """
+    Returns q-th percentile of values of several sorted runs, equal to
+    percentile() of all of them merged. Values of closest ranks are found
+    with select(), without merging the runs.
+    """
+    size = sum(len(run) for run in runs)
+    if not size:
+        return 0
+    position = (size - 1) * q / 100.0
+    lower = int(position)
+    upper = min(lower + 1, size - 1)
+    low = select(runs, lower)
+    high = select(runs, upper) if upper != lower else low
+    return low + (high - low) * (position - lower)
+
+
+def group_aggregate(data, statistic, field, user_ids, first=None, last=None,
+                    quantiles=(50, 90)):
+    """
+    Aggregates given field of presence entries of given users by weekday.
+
+    Statistic is one of 'mean', 'sum' or 'percentile'; mean and sum are
+    computed from users' weekday totals, percentiles from users' sorted
+    values without merging them.
+    """
+    if statistic == 'percentile':
+        values = group_values(data, user_ids, field, first, last)
+        return [
+            [calendar.day_abbr[weekday]] + [
+                runs_percentile(values[weekday], q) for q in quantiles
+            ]
+            for weekday in range(7)
+        ]
+
+    index = group_index(data, user_ids, first, last)
+    totals = getattr(index, FIELDS[field])
+    if statistic == 'mean':
+        return [
+            (calendar.day_abbr[weekday], index.mean(totals, weekday))
+            for weekday in range(7)
+        ]
+    return [(calendar.day_abbr[weekday], totals[weekday])
+            for weekday in range(7)]
+
+
+# columns of exported per-user weekday aggregates
+EXPORT_FIELDS = (
+    'user_id',
+    'weekday',
+    'days',
+    'presence',
+    'mean_presence',
+    'mean_start',
+    'mean_end',
+)
+
+
+def export_rows(data, user_ids, first=None, last=None):
+    """
+    Yields weekday aggregates of given users as tuples of EXPORT_FIELDS.
+
+    Totals of date ranges are not put into aggregates cache, so that
+    exporting all users does not evict values used by API views.
+    """
+    for user_id in user_ids:
+        if user_id not in data:
+            continue
+        index = data[user_id].weekday_index(first, last)
+        for weekday in range(7):
+            yield (
+                user_id,
+                calendar.day_abbr[weekday],
+                index.counts[weekday],
+                index.intervals[weekday],
+                index.mean(index.intervals, weekday),
+                index.mean(index.starts, weekday),
+                index.mean(index.ends, weekday),
+            )
+
+
+class _LineBuffer(object):
+    """
+    File-like object keeping only the last written line.
+    """
+    line = ''
+
+    def write(self, line):
+        """
+        Stores written line.
+        """
+        self.line = line
+
+
+def csv_lines(rows, header):
+    """
+    Yields given rows as CSV lines, preceded by header.
+    """
+    buf = _LineBuffer()
+    writer = csv.writer(buf)
+    for row in chain([header], rows):
+        writer.writerow(row)
+        yield buf.line
+
+
+def ndjson_lines(rows, fields):
+    """
+    Yields given rows as JSON objects with given fields, one per line.
+    """
+    for row in rows:
+        yield dumps(dict(izip(fields, row))) + '\n'
+
+
+def parse_date_range(args):
+    """
+    Returns (first, last) day ordinals from 'from' and 'to' query
+    arguments in YYYY-MM-DD format, None for missing ones.
+    """
+    return tuple(
+        parse_date(args[name]) if args.get(name) else None
+        for name in ('from', 'to')
+    )
+
+
 def seconds_since_midnight(time):
     """
     Calculates amount of seconds since midnight.
@@ -138,19 +1437,338 @@ def mean(items):
     return float(sum(items)) / len(items) if len(items) > 0 else 0
 
 
+class Warmup(object):
+    """
+    Loads presence data and users in background thread, so that the first
+    requests do not have to wait for it.
+
+    While data is unavailable, such as before the first snapshot is
+    written, loading is retried every retry_seconds and requests are held.
+    """
+    steps = ('data', 'users')
+    retry_seconds = 1
+
+    def __init__(self):
+        self.state = 'idle'
+        self.done = []
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.ready = threading.Event()
+
+    def start(self):
+        """
+        Starts loading in background thread.
+        """
+        self.state = 'loading'
+        self.started = time.time()
+        thread = threading.Thread(target=self._run, name='warmup')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        """
+        Loads all the data, recording progress.
+        """
+        while True:
+            try:
+                if 'data' not in self.done:
+                    get_data()
+                    self.done.append('data')
+                get_users()
+                self.done.append('users')
+            except DataUnavailable as error:
+                log.info('Warm-up waiting for data: %s', error)
+                self.error = repr(error)
+                time.sleep(self.retry_seconds)
+                continue
+            except Exception as error:  # pylint: disable-msg=W0703
+                log.exception('Warm-up failed')
+                self.error = repr(error)
+                self.state = 'failed'
+            else:
+                self.error = None
+                self.state = 'ready'
+            break
+        self.finished = time.time()
+        # requests are let through also after failure, they will load the
+        # data themselves
+        self.ready.set()
+
+    def wait(self, timeout):
+        """
+        Waits at most 'timeout' seconds for warm-up to finish. Returns True
+        when requests can be handled.
+        """
+        if self.state == 'idle':
+            return True
+        return self.ready.wait(timeout)
+
+    def status(self):
+        """
+        Returns warm-up state and progress.
+        """
+        finished = self.finished or time.time()
+        return {
+            'state': self.state,
+            'progress': float(len(self.done)) / len(self.steps),
+            'done': list(self.done),
+            'error': self.error,
+            'seconds': finished - self.started if self.started else 0.0,
+        }
+
+
+warmup = Warmup()  # pylint: disable-msg=C0103
+
+
 def parse_users_xml():
     """
     Parses the XML file
     """
-    users_data = app.config['USERS_XML']
+    return get_users().listing
 
-    with open(users_data, 'r') as f:
-        users = etree.parse(f).find('users')
 
-    return [
-        {
+@timed_phase('load')
+def get_users():
+    """
+    Returns Users directory read from USERS_XML.
+
+    The file is parsed again only when its size or modification time
+    changes. With STORAGE set to 'snapshot' users are read only from
+    snapshot written by DataService, see SnapshotUsersLoader.
+    """
+    storage = app.config.get('STORAGE', 'csv')
+    key = (storage == 'snapshot', app.config['USERS_XML'],
+           app.config['DATA_CSV'])
+    with _loaders_lock:
+        loader = _users_loaders.get(key)
+        if loader is None:
+            if key[0]:
+                loader = SnapshotUsersLoader(key[2])
+            else:
+                loader = UsersLoader(*key[1:])
+            _users_loaders[key] = loader
+    return loader.load()
+
+
+class Users(object):
+    """
+    Users directory.
+
+    Keeps users listing for dropdowns, its serialized JSON and map of
+    user_id to full user records.
+    """
+
+    def __init__(self, records, version=None, modified=None):
+        self.version = version
+        self.modified = modified
+        self.by_id = {record['user_id']: record for record in records}
+        self.listing = [
+            {'user_id': record['user_id'], 'name': record['name']}
+            for record in records
+        ]
+        self.json = JSON(dumps(self.listing))
+
+
+class UsersLoader(object):
+    """
+    Loads users XML file again only when it has changed.
+
+    Users are taken from snapshot of presence data when it is up to date.
+    """
+
+    def __init__(self, path, csv_path):
+        self.path = path
+        self.csv_path = csv_path
+        self.state = None
+        self.users = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Returns Users with current content of the file.
+        """
+        with self.lock:
+            state = file_state(self.path)
+            if state != self.state:
+                records = snapshot_users(self.csv_path, self.path)
+                if records is None:
+                    records = read_users_xml(self.path)
+                self.users = Users(
+                    records,
+                    version='%x-%r' % (state['size'], state['mtime']),
+                    modified=state['mtime'],
+                )
+                self.state = state
+            return self.users
+
+
+class SnapshotUsersLoader(object):
+    """
+    Reads users from snapshot written by DataService again whenever it is
+    replaced. Users file itself is never parsed.
+    """
+
+    def __init__(self, csv_path):
+        self.path = snapshot.snapshot_path(csv_path)
+        self.state = None
+        self.users = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Returns Users stored in current snapshot. Raises DataUnavailable
+        until the snapshot is written.
+        """
+        with self.lock:
+            state = _snapshot_state(self.path)
+            if state is None:
+                if self.users is None:
+                    raise DataUnavailable('%s is not written yet' % self.path)
+                return self.users
+            if state != self.state:
+                meta = snapshot.read_meta(self.path)
+                # versioned like by UsersLoader, so that ETags do not
+                # depend on the way users were loaded
+                source = meta['users_xml']
+                self.users = Users(
+                    meta['users'],
+                    version='%x-%r' % (source['size'], source['mtime']),
+                    modified=source['mtime'],
+                )
+                self.state = state
+            return self.users
+
+
+_users_loaders = {}
+
+
+def read_users_xml(path):
+    """
+    Reads list of users from given XML file.
+    """
+    return list(iter_users_xml(path))
+
+
+def iter_users_xml(path):
+    """
+    Yields users from given XML file one by one.
+
+    The file is parsed incrementally and processed elements are dropped,
+    so memory use does not grow with the size of the file.
+    """
+    for _, user in etree.iterparse(path, events=('end',), tag='user'):
+        yield {
             'user_id': int(user.get('id')),
-            'name': user.find('name').text
+            'name': user.findtext('name'),
+            'avatar': user.findtext('avatar'),
         }
-        for user in users
-    ]
+        user.clear()
+        while user.getprevious() is not None:
+            del user.getparent()[0]
+
+
+def file_state(path):
+    """
+    Returns size and modification time of given file.
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def snapshot_users(csv_path, users_path):
+    """
+    Returns users stored in snapshot of presence data or None if there is
+    no snapshot or users file has changed since it was written.
+    """
+    path = snapshot.snapshot_path(csv_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        meta = snapshot.read_meta(path)
+        if meta.get('users_xml') != file_state(users_path):
+            return None
+        return meta['users']
+    except (EnvironmentError, ValueError, KeyError, snapshot.SnapshotError):
+        log.warning('Cannot read snapshot %s', path, exc_info=True)
+        return None
+
+
+def write_snapshot():
+    """
+    Writes snapshot of presence data and users next to DATA_CSV.
+    """
+    service = DataService(app.config['DATA_CSV'], app.config['USERS_XML'])
+    service.update()
+    return service.path
+
+
+class DataService(object):
+    """
+    Keeps snapshot of presence data and users up to date.
+
+    Run as single process per host, it is the only one which parses
+    DATA_CSV and USERS_XML. DATA_CSV can be a directory or a glob pattern
+    of files too, snapshot of them is written next to it with
+    '.snapshot' suffix. Web workers with STORAGE = 'snapshot' map the
+    snapshot it writes, so data is reloaded once per host and shared by
+    all the workers.
+    """
+
+    def __init__(self, csv_path, users_path):
+        self.path = snapshot.snapshot_path(csv_path)
+        self.users_path = users_path
+        self.loader = _csv_loader(
+            csv_path, app.config.get('PARSE_PROCESSES', cpu_count())
+        )
+        self.generation = None
+        self.users_state = None
+        self.users = None
+        self.writes = 0
+        self.stopped = threading.Event()
+
+    def update(self):
+        """
+        Parses lines appended to presence file and users file if it
+        changed, and writes new snapshot. Returns False when nothing
+        changed since the last update.
+        """
+        data = self.loader.load()
+        users_state = file_state(self.users_path)
+        if data.generation == self.generation and \
+                users_state == self.users_state:
+            return False
+        if users_state != self.users_state:
+            self.users = read_users_xml(self.users_path)
+        meta = {
+            'version': data.version,
+            'modified': data.modified,
+            'rejected': self.loader.stats()['rejected'],
+            'users_xml': users_state,
+        }
+        if isinstance(self.loader, PresenceLoader):
+            # lets PresenceLoader continue parsing after restoring it
+            meta['csv'] = self.loader.state()
+        snapshot.write(self.path, data, self.users, meta=meta)
+        self.generation = data.generation
+        self.users_state = users_state
+        self.writes += 1
+        log.info('Wrote %s', self.path)
+        return True
+
+    def serve(self, interval=5):
+        """
+        Updates snapshot every 'interval' seconds until stopped.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.update()
+            except Exception:  # pylint: disable-msg=W0703
+                log.exception('Updating %s failed', self.path)
+            self.stopped.wait(interval)
+
+    def stop(self):
+        """
+        Stops serve() loop.
+        """
+        self.stopped.set()
@@ -3,15 +3,33 @@
 Defines views.
 """
 
-import calendar
-from flask import render_template, abort
+from flask import render_template, abort, request, Response
 from presence_analyzer.main import app
-from presence_analyzer import utils
+from presence_analyzer import instrumentation, metrics, utils
 from jinja2 import TemplateNotFound
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 
+@app.before_request
+def wait_for_warmup():
+    """
+    Holds requests until background warm-up finishes, for at most
+    WARMUP_TIMEOUT seconds, then answers with 503.
+    """
+    if request.endpoint in ('ready_view', 'stats_view', 'metrics_view',
+                            'static'):
+        return None
+    with instrumentation.phase('load'):
+        ready = utils.warmup.wait(app.config.get('WARMUP_TIMEOUT', 5))
+    if not ready:
+        response = utils.jsonify(utils.warmup.status)()
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+    return None
+
+
 @app.route('/')
 def mainpage():
     """
@@ -42,75 +60,368 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+@app.errorhandler(utils.DataUnavailable)
+def data_unavailable(error):
+    """
+    Answers with 503 until presence data becomes available, such as before
+    the first snapshot is written.
+    """
+    log.warning('Data unavailable: %s', error)
+    response = utils.jsonify(lambda: {'error': str(error)})()
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def _weekday_index(data, user_id):
+    """
+    Returns WeekdayIndex of user limited to 'from' and 'to' dates given
+    in query string.
+    """
+    try:
+        first, last = utils.parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid date range: %s', request.args, exc_info=True)
+        abort(400)
+    return utils.weekday_index(data, user_id, first, last)
+
+
+def _list_arg(name):
+    """
+    Returns values of query argument given repeatedly or comma separated.
+    """
+    return [
+        value
+        for arg in request.args.getlist(name)
+        for value in arg.split(',')
+        if value
+    ]
+
+
+@app.route('/api/v1/ready', methods=['GET'])
+def ready_view():
+    """
+    Reports progress of loading data at startup. Returns 503 until it is
+    finished.
+    """
+    response = utils.jsonify(utils.warmup.status)()
+    if utils.warmup.state == 'loading':
+        response.status_code = 503
+    return response
+
+
+@app.route('/api/v1/stats', methods=['GET'])
+@utils.jsonify
+def stats_view():
+    """
+    Returns request latency statistics per endpoint, split into data
+    loading, aggregation and serialization phases, and recently captured
+    profiles. Collected only when INSTRUMENTATION is enabled.
+    """
+    result = instrumentation.stats.summary()
+    result['enabled'] = bool(app.config.get('INSTRUMENTATION'))
+    result['profiling'] = app.config.get('PROFILING')
+    return result
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns loader, cache, request and process metrics in Prometheus text
+    format. Request metrics are collected only with INSTRUMENTATION.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/api/v1/users', methods=['GET'])
+@utils.conditional(utils.users_version)
 @utils.jsonify
 def users_view():
     """
     Users listing for dropdown.
     """
-    return utils.parse_users_xml()
+    return utils.get_users().json
+
+
+@app.route('/api/v1/users/<int:user_id>', methods=['GET'])
+@utils.conditional(utils.users_version)
+@utils.jsonify
+def user_view(user_id):
+    """
+    Returns user details with avatar.
+    """
+    try:
+        return utils.get_users().by_id[user_id]
+    except KeyError:
+        log.debug('User %s not found!', user_id)
+        abort(404)
 
 
 @app.route('/api/v1/mean_time_weekday/', methods=['GET'])
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
-@utils.jsonify
+@utils.conditional(utils.data_version)
+@utils.jsonify(cached=True)
 def mean_time_weekday_view(user_id=None):
     """
     Returns mean presence time of given user grouped by weekday.
+
+    Optional 'from' and 'to' query arguments (YYYY-MM-DD) limit the dates.
     """
     data = utils.get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = utils.group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], utils.mean(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    return result
+    return utils.mean_time_weekday(_weekday_index(data, user_id))
 
 
 @app.route('/api/v1/presence_weekday/', methods=['GET'])
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
-@utils.jsonify
+@utils.conditional(utils.data_version)
+@utils.jsonify(cached=True)
 def presence_weekday_view(user_id=None):
     """
     Returns total presence time of given user grouped by weekday.
+
+    Optional 'from' and 'to' query arguments (YYYY-MM-DD) limit the dates.
     """
     data = utils.get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = utils.group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return utils.presence_weekday(_weekday_index(data, user_id))
 
 
 @app.route('/api/v1/presence_start_end/', methods=['GET'])
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
-@utils.jsonify
+@utils.conditional(utils.data_version)
+@utils.jsonify(cached=True)
 def presence_start_end_view(user_id=None):
     """
     Return average presence time of given user
+
+    Optional 'from' and 'to' query arguments (YYYY-MM-DD) limit the dates.
     """
     data = utils.get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         return []
 
-    start_end_by_weekday = utils.group_start_end_by_weekday(data[user_id])
+    return utils.presence_start_end(_weekday_index(data, user_id))
 
-    result = [
-        (
-            calendar.day_abbr[weekday],
-            utils.mean(intervals['starts']),
-            utils.mean(intervals['ends'])
+
+@app.route('/api/v1/aggregate/<statistic>', methods=['GET'])
+@utils.conditional(utils.data_version)
+@utils.jsonify(cached=True)
+def aggregate_view(statistic):
+    """
+    Returns statistic of presence entries of many users grouped by weekday.
+
+    Statistic is one of 'mean', 'sum' or 'percentile', computed over
+    'field' query argument: 'interval' (default), 'start' or 'end'.
+    Users are given as 'user_id' arguments, all users by default.
+    Percentiles to compute are given as 'q' arguments, 50 and 90 by
+    default. Optional 'from' and 'to' arguments limit the dates.
+    """
+    field = request.args.get('field', 'interval')
+    if statistic not in ('mean', 'sum', 'percentile') or \
+            field not in utils.FIELDS:
+        abort(404)
+    try:
+        user_ids = tuple(int(user_id) for user_id in _list_arg('user_id'))
+        quantiles = tuple(float(q) for q in _list_arg('q')) or (50, 90)
+        first, last = utils.parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid arguments: %s', request.args, exc_info=True)
+        abort(400)
+    if not all(0 <= q <= 100 for q in quantiles):
+        abort(400)
+
+    data = utils.get_data()
+    return utils.aggregates.get(
+        data.generation,
+        ('aggregate', statistic, field, user_ids, first, last, quantiles),
+        lambda: utils.group_aggregate(
+            data, statistic, field, user_ids or data.keys(), first, last,
+            quantiles
+        ),
+    )
+
+
+@app.route('/api/v1/distribution', methods=['GET'])
+@app.route('/api/v1/distribution/<int:user_id>', methods=['GET'])
+@utils.conditional(utils.data_version)
+@utils.jsonify(cached=True)
+def distribution_view(user_id=None):
+    """
+    Returns percentiles and histograms of start, end and interval of
+    presence entries per weekday. Percentiles are exact, as in
+    /api/v1/aggregate/percentile.
+
+    They are computed for given user, or for users given as 'user_id'
+    arguments, all users by default. Percentiles to compute are given as
+    'q' arguments, 50 and 90 by default. Optional 'from' and 'to'
+    arguments limit the dates.
+    """
+    try:
+        user_ids = tuple(int(user_id) for user_id in _list_arg('user_id'))
+        quantiles = tuple(float(q) for q in _list_arg('q')) or (50, 90)
+        first, last = utils.parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid arguments: %s', request.args, exc_info=True)
+        abort(400)
+    if not all(0 <= q <= 100 for q in quantiles):
+        abort(400)
+
+    data = utils.get_data()
+    if user_id is not None:
+        if user_id not in data:
+            log.debug('User %s not found!', user_id)
+            return []
+        user_ids = (user_id,)
+    return utils.aggregates.get(
+        data.generation,
+        ('distribution', user_ids, first, last, quantiles),
+        lambda: utils.distribution(
+            data, user_ids or data.keys(), first, last, quantiles
+        ),
+    )
+
+
+@app.route('/api/v1/timeseries/<period>', methods=['GET'])
+@app.route('/api/v1/timeseries/<period>/<int:user_id>', methods=['GET'])
+@utils.conditional(utils.data_version)
+@utils.jsonify(cached=True)
+def timeseries_view(period, user_id=None):
+    """
+    Returns amount of days and total presence time per ISO week or month.
+
+    Period is 'week' or 'month'. Totals are computed for given user, or
+    summed for users given as 'user_id' arguments, all users by default.
+    Optional 'from' and 'to' arguments limit the periods to ones which
+    contain the dates.
+    """
+    if period not in utils.PERIODS:
+        abort(404)
+    try:
+        user_ids = tuple(int(user_id) for user_id in _list_arg('user_id'))
+        first, last = utils.parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid arguments: %s', request.args, exc_info=True)
+        abort(400)
+
+    data = utils.get_data()
+    if user_id is not None:
+        if user_id not in data:
+            log.debug('User %s not found!', user_id)
+            return []
+        rollup = getattr(data[user_id], utils.PERIODS[period][0])
+    else:
+        rollup = utils.aggregates.get(
+            data.generation,
+            ('group_rollup', period, user_ids),
+            lambda: utils.group_rollup(
+                data, user_ids or data.keys(), period
+            ),
         )
-        for weekday, intervals in start_end_by_weekday.items()
-    ]
+    return utils.timeseries(rollup, period, first, last)
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@utils.conditional(utils.data_version)
+@utils.jsonify(cached=True)
+def occupancy_view():
+    """
+    Returns mean amount of people present in each 15 minute slot of each
+    weekday, as weekday x slot matrix.
+
+    Users are given as 'user_id' arguments, all users by default.
+    Optional 'from' and 'to' arguments limit the dates.
+    """
+    try:
+        user_ids = tuple(int(user_id) for user_id in _list_arg('user_id'))
+        first, last = utils.parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid arguments: %s', request.args, exc_info=True)
+        abort(400)
+
+    data = utils.get_data()
+    return utils.aggregates.get(
+        data.generation,
+        ('occupancy', user_ids, first, last),
+        lambda: utils.occupancy(
+            data, user_ids or data.keys(), first, last
+        ),
+    )
+
+
+@app.route('/api/v1/export', methods=['GET'])
+@utils.conditional(utils.data_version)
+def export_view():
+    """
+    Streams weekday aggregates of all users as CSV or NDJSON.
+
+    Output format is given as 'format' query argument: 'csv' (default)
+    or 'ndjson'. Optional 'user_id' arguments limit the users and 'from'
+    and 'to' arguments the dates.
+    """
+    output = request.args.get('format', 'csv')
+    if output not in ('csv', 'ndjson'):
+        abort(400)
+    try:
+        user_ids = [int(user_id) for user_id in _list_arg('user_id')]
+        first, last = utils.parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid arguments: %s', request.args, exc_info=True)
+        abort(400)
+
+    data = utils.get_data()
+    rows = utils.export_rows(data, user_ids or sorted(data), first, last)
+    if output == 'csv':
+        lines = utils.csv_lines(rows, utils.EXPORT_FIELDS)
+        mimetype = 'text/csv'
+    else:
+        lines = utils.ndjson_lines(rows, utils.EXPORT_FIELDS)
+        mimetype = 'application/x-ndjson'
+    response = Response(lines, mimetype=mimetype)
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=presence.%s' % output
+    return response
+
+
+@app.route('/api/v1/batch', methods=['GET'])
+@utils.conditional(utils.data_version)
+@utils.jsonify(cached=True)
+def batch_view():
+    """
+    Returns several metrics of several users at once.
+
+    Users and metrics are given as 'user_id' and 'metric' query arguments,
+    repeated or comma separated. All metrics are returned when none is
+    given. Optional 'from' and 'to' arguments limit the dates.
+    """
+    try:
+        user_ids = [int(user_id) for user_id in _list_arg('user_id')]
+        first, last = utils.parse_date_range(request.args)
+    except ValueError:
+        log.debug('Invalid arguments: %s', request.args, exc_info=True)
+        abort(400)
+    names = _list_arg('metric') or sorted(utils.METRICS)
+    if not set(names) <= set(utils.METRICS):
+        log.debug('Unknown metrics: %s', names)
+        abort(400)
+
+    data = utils.get_data()
+    result = {}
+    for user_id in user_ids:
+        if user_id not in data:
+            log.debug('User %s not found!', user_id)
+            result[user_id] = {name: [] for name in names}
+            continue
+        index = utils.weekday_index(data, user_id, first, last)
+        result[user_id] = {
+            name: utils.METRICS[name](index) for name in names
+        }
 
     return result